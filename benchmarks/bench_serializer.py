@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Cost per message of the PushManager client serializers, by payload type and size:
+#   dill:  convert_callables, then the pickle Connection.send / recv (the 'dill' serializer)
+#   push:  CallablePickler with out-of-band buffers over send_framed / recv_framed (the 'push' serializer)
+# Messages go over a local socket pair with a thread receiving, as a BaseManager request would; n/a marks
+# payloads the dill serializer cannot send at all.  Both are first checked to round trip a class passed alongside
+# an instance of it, which the server must be able to load.
+#
+#   ex usage:
+#       python benchmarks/bench_serializer.py [max_size_mb]
+
+import datetime
+import io
+import pickle
+import socket
+import sys
+import threading
+import time
+from array import array
+from fractions import Fraction
+
+import dill
+from multiprocessing.connection import Connection
+
+from pushpy.push_manager import convert_callables, send_framed, recv_framed, CallablePickler
+
+
+def connection_pair():
+    a, b = socket.socketpair()
+    return Connection(a.detach()), Connection(b.detach())
+
+
+def send_dill(conn, obj):
+    conn.send(convert_callables(obj))
+
+
+def send_push(conn, obj):
+    send_framed(conn, obj, CallablePickler)
+
+
+def dumps_dill(obj):
+    pickle.dumps(convert_callables(obj))
+
+
+def dumps_push(obj):
+    CallablePickler(io.BytesIO()).dump(obj)
+
+
+def run(send, recv, tx, rx, msg, count):
+    # the reader runs alongside so large messages do not fill the socket buffer
+    reader = threading.Thread(target=lambda: [recv(rx) for _ in range(count)])
+    start = time.perf_counter()
+    reader.start()
+    for _ in range(count):
+        send(tx, msg)
+    reader.join()
+    return time.perf_counter() - start
+
+
+def bench(dumps, send, recv, msg, seconds=0.5):
+    try:
+        dumps(msg)
+    except Exception:
+        return None
+    tx, rx = connection_pair()
+    try:
+        count = max(1, min(10000, int(seconds / run(send, recv, tx, rx, msg, 1))))
+        return run(send, recv, tx, rx, msg, count) / count
+    finally:
+        tx.close()
+        rx.close()
+
+
+def check(send, recv):
+    tx, rx = connection_pair()
+    try:
+        for cls, value in ((Fraction, Fraction(1, 3)), (datetime.date, datetime.date(2020, 1, 1))):
+            send(tx, (cls, value, {'cls': cls, 'v': value}))
+            c, v, d = recv(rx)
+            assert dill.loads(c) is cls and v == value, (c, v)
+            assert dill.loads(d['cls']) is cls and d['v'] == value, d
+    finally:
+        tx.close()
+        rx.close()
+
+
+def fmt(t):
+    return f"{t * 1e6:>12.1f}" if t is not None else f"{'n/a':>12}"
+
+
+def payloads(size):
+    n = size // 8
+    yield "bytes", bytes(size)
+    yield "memoryview", memoryview(bytearray(size))
+    yield "array('d')", array('d', range(n))
+    yield "list[float]", [float(i) for i in range(min(n, 1 << 20))]
+
+
+def main(max_size_mb=16):
+    check(send_dill, lambda c: c.recv())
+    check(send_push, recv_framed)
+    print(f"{'payload':<12} {'size':>10} {'dill us':>12} {'push us':>12} {'speedup':>8}")
+    size = 1024
+    while size <= max_size_mb * 1024 * 1024:
+        for name, payload in payloads(size):
+            msg = ("id", "apply", ("my_lambda", payload), {})
+            t_dill = bench(dumps_dill, send_dill, lambda c: c.recv(), msg)
+            t_push = bench(dumps_push, send_push, recv_framed, msg)
+            speedup = f"{t_dill / t_push:>8.2f}" if t_dill is not None else f"{'':>8}"
+            print(f"{name:<12} {size:>10} {fmt(t_dill)} {fmt(t_push)} {speedup}")
+        size *= 16
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16)
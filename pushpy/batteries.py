@@ -1,16 +1,24 @@
 from __future__ import print_function
 
+import asyncio
+import calendar
 import hashlib
+import lzma
 import os
 import socket
+import sys
 import threading
 import time
+import uuid
 import weakref
-from collections import Mapping
-from typing import ValuesView, ItemsView
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from collections.abc import Mapping, KeysView, ItemsView, ValuesView
 
 import dill
-from pysyncobj import replicated, SyncObjConsumer
+from pysyncobj import replicated, SyncObjConsumer, SyncObjException
 from pysyncobj.batteries import ReplDict
 
 
@@ -48,24 +56,371 @@ class ReplEventDict(ReplDict):
 #   obj['/']
 #   obj.get("/")
 
+# Codecs for stored blobs, selected by the first byte of the blob.  dill pickles always start with the PROTO
+# opcode (0x80), so a value that is not worth compressing is stored as the bare pickle with no header.
+BLOB_PICKLE = 0x80
+BLOB_RAW = 0x00
+_BLOB_CODECS = {
+    BLOB_RAW: ('raw', bytes, bytes),
+    ord('z'): ('zlib', zlib.compress, zlib.decompress),
+    ord('x'): ('lzma', lzma.compress, lzma.decompress),
+}
+
+
+def register_blob_codec(codec_id, name, compress, decompress):
+    if codec_id == BLOB_PICKLE or codec_id in _BLOB_CODECS:
+        raise ValueError(f"blob codec id already in use: {codec_id}")
+    _BLOB_CODECS[codec_id] = (name, compress, decompress)
+
+
+def blob_codec_id(name):
+    if name is None:
+        return BLOB_RAW
+    for codec_id, codec in _BLOB_CODECS.items():
+        if codec[0] == name:
+            return codec_id
+    raise ValueError(f"unknown blob codec: {name}")
+
+
+def encode_blob(data, codec_id=BLOB_RAW):
+    return bytes([codec_id]) + _BLOB_CODECS[codec_id][1](data)
+
+
+def decode_blob(blob):
+    if blob[0] == BLOB_PICKLE:
+        return blob
+    return _BLOB_CODECS[blob[0]][2](memoryview(blob)[1:])
+
+
+# Content-defined chunking (gear rolling hash) so that a small edit to a large blob only changes the
+# chunks around the edit; unchanged chunks keep their content hash and are stored / replicated once.
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_AVG_SIZE = 64 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+
+# derived from sha256 rather than random so that every node picks the same chunk boundaries
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'little') for i in range(256)]
+_GEAR_BITS = 0xFFFFFFFFFFFFFFFF
+
+
+def chunk_data(data, min_size=CHUNK_MIN_SIZE, avg_size=CHUNK_AVG_SIZE, max_size=CHUNK_MAX_SIZE):
+    # the low bits of a gear hash only see the last few bytes, so the boundary test uses the high bits
+    bits = max((avg_size - min_size).bit_length() - 1, 1)
+    mask = ((1 << bits) - 1) << (64 - bits)
+    gear = _GEAR
+    mv = memoryview(data)
+    n = len(mv)
+    chunks = []
+    start = 0
+    while start < n:
+        end = min(start + max_size, n)
+        h = 0
+        i = start + min_size
+        for b in mv[i:end]:
+            i += 1
+            h = ((h << 1) + gear[b]) & _GEAR_BITS
+            if not h & mask:
+                end = i
+                break
+        chunks.append(bytes(mv[start:end]))
+        start = end
+    return chunks
+
+
+# Per-key version history held as parallel arrays sorted by version so that resolving
+# a key at a version is a bisect instead of a walk over every deploy of that key.
+class _KeyHistory:
+    __slots__ = ('versions', 'obj_keys')
+
+    def __init__(self, versions=None, obj_keys=None):
+        self.versions = array('q', versions or [])
+        self.obj_keys = list(obj_keys or [])
+
+    def __getstate__(self):
+        return self.versions, self.obj_keys
+
+    def __setstate__(self, state):
+        self.versions, self.obj_keys = state
+
+    def __len__(self):
+        return len(self.versions)
+
+    def append(self, version, obj_key):
+        self.versions.append(version)
+        self.obj_keys.append(obj_key)
+
+    def floor(self, version):
+        i = bisect_right(self.versions, version)
+        return self.obj_keys[i - 1] if i > 0 else None
+
+
+# a total order over keys of any type, str keys first in their natural order
+def _key_order(k):
+    return (0, k, '') if isinstance(k, str) else (1, type(k).__name__, repr(k))
+
+
+# Bounded LRU of deserialized objects keyed by content hash.  Content hashes are immutable,
+# so entries never need invalidating; they are only evicted by count / serialized size.
+class _ObjectCache:
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, load):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        obj, size = load()
+        if size > self.max_bytes:
+            return obj
+        with self.__lock:
+            if key not in self.__entries:
+                self.__entries[key] = (obj, size)
+                self.__bytes += size
+            while len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes:
+                _, (_, evicted_size) = self.__entries.popitem(last=False)
+                self.__bytes -= evicted_size
+                self.evictions += 1
+        return obj
+
+    def discard(self, key):
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__bytes -= entry[1]
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'entries': len(self.__entries),
+                'bytes': self.__bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+# Immutable key -> value mapping of a ReplVersionedDict at a single version.  Values are deserialized lazily
+# on access.  When sent over a PushManager connection only the keys and the serialized blobs of this
+# version are pickled, so the client does the deserialization and the store is never materialized.
+class VersionSnapshot(Mapping):
+
+    def __init__(self, version, refs, load, data):
+        self.version = version
+        self.__refs = refs
+        self.__load = load
+        self.__data = data
+
+    def __getitem__(self, k):
+        return self.__load(self.__refs[k])
+
+    def __iter__(self):
+        return iter(self.__refs)
+
+    def __len__(self):
+        return len(self.__refs)
+
+    def __contains__(self, k):
+        return k in self.__refs
+
+    def ref(self, k):
+        return self.__refs.get(k)
+
+    def __reduce__(self):
+        blobs = {}
+        for obj_key in self.__refs.values():
+            if obj_key not in blobs:
+                blobs[obj_key] = self.__data(obj_key)
+        return VersionSnapshot._detached, (self.version, self.__refs, blobs)
+
+    @staticmethod
+    def _detached(version, refs, blobs):
+        loaded = {}
+
+        def load(obj_key):
+            if obj_key not in loaded:
+                data = blobs.get(obj_key)
+                loaded[obj_key] = dill.loads(decode_blob(data)) if data is not None else None
+            return loaded[obj_key]
+
+        return VersionSnapshot(version, refs, load, blobs.get)
+
+
+class VersionedKeysView(KeysView):
+
+    def __init__(self, snapshot: VersionSnapshot):
+        super(VersionedKeysView, self).__init__(snapshot)
+
+    @property
+    def version(self):
+        return self._mapping.version
+
+    # only the keys and their content hashes are sent over a PushManager connection
+    def __reduce__(self):
+        return VersionedKeysView._detached, (self._mapping.version, {k: self._mapping.ref(k) for k in self._mapping})
+
+    @staticmethod
+    def _detached(version, refs):
+        return VersionedKeysView(VersionSnapshot(version, refs, lambda _: None, lambda _: None))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({list(self)})"
+
+
+class VersionedItemsView(ItemsView):
+
+    def __init__(self, snapshot: VersionSnapshot):
+        super(VersionedItemsView, self).__init__(snapshot)
+
+    @property
+    def version(self):
+        return self._mapping.version
+
+    def __reduce__(self):
+        return VersionedItemsView, (self._mapping,)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({list(self)})"
+
+
+class VersionedValuesView(ValuesView):
+
+    def __init__(self, snapshot: VersionSnapshot):
+        super(VersionedValuesView, self).__init__(snapshot)
+
+    @property
+    def version(self):
+        return self._mapping.version
+
+    def __reduce__(self):
+        return VersionedValuesView, (self._mapping,)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({list(self)})"
+
+
 # TODO: grab a lock for commit transaction otherwise a separate process can
 class ReplVersionedDict(SyncObjConsumer, Mapping):
 
-    def __init__(self, on_head_change=None):
+    def __init__(self, on_head_change=None, cache_size=1024, cache_bytes=64 * 1024 * 1024,
+                 chunk_threshold=4 * CHUNK_MAX_SIZE, compression='zlib', compress_threshold=1024):
         self.on_head_change = on_head_change
+        self.__head_listeners = []
+        # blobs at least compress_threshold bytes are compressed by the node writing them, before they are hashed
+        # and replicated, which shrinks log entries, full dumps and the chunks replicated by set_chunked
+        self.__codec_id = blob_codec_id(compression)
+        self.compress_threshold = compress_threshold
+        self.__compression_stats = {'blobs': 0, 'compressed': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+        # set_chunked stores serialized values at least this large as a manifest of content-defined chunks
+        self.chunk_threshold = max(chunk_threshold, CHUNK_MAX_SIZE + 1)
+        # deserialized objects are shared between readers, so callers should not mutate values returned by get
+        self.__obj_cache = _ObjectCache(max_entries=cache_size, max_bytes=cache_bytes)
+        # local indexes (not replicated) derived from __references, rebuilt on _deserialize
+        self.__version_keys = {}
+        self.__sorted_keys = []
+        self.__refcounts = {}
+        self.__resolved = {}
+        self.__resolved_version = None
+        self.__last_flatten = None
         super(ReplVersionedDict, self).__init__()
         self.__objects = {}
+        self.__manifests = {}
         self.__references = {}
         self.__version = None
         self.__head = None
-        self.__len_cache = {}
+        self.__min_version = None
 
     def clear(self):
         self.__objects = {}
+        self.__manifests = {}
         self.__references = {}
         self.__version = None
         self.__head = None
-        self.__len_cache = {}
+        self.__min_version = None
+        self.__obj_cache.clear()
+        self.__rebuild_indexes()
+
+    def _deserialize(self, data):
+        super(ReplVersionedDict, self)._deserialize(data)
+        self.__rebuild_indexes()
+
+    def __rebuild_indexes(self):
+        version_keys = {}
+        refcounts = {}
+        for key, hist in self.__references.items():
+            if not isinstance(hist, _KeyHistory):
+                hist = _KeyHistory([v for v, _ in hist], [o for _, o in hist])
+                self.__references[key] = hist
+            for v in hist.versions:
+                version_keys.setdefault(v, []).append(key)
+            for obj_key in hist.obj_keys:
+                if obj_key is not None:
+                    refcounts[obj_key] = refcounts.get(obj_key, 0) + 1
+        # each manifest holds one reference to each of its (distinct) chunks
+        for chunk_keys in self.__manifests.values():
+            for chunk_key in set(chunk_keys):
+                refcounts[chunk_key] = refcounts.get(chunk_key, 0) + 1
+        self.__version_keys = version_keys
+        self.__sorted_keys = sorted(k for k in self.__references.keys() if isinstance(k, str))
+        self.__refcounts = refcounts
+        self.__resolved = {}
+        self.__resolved_version = None
+        self.__resolve_head()
+
+    # Maintain the key -> obj_key map for HEAD.  The map is never mutated once published, so
+    # readers can iterate it while a replicated update swaps in the next one.
+    def __resolve_head(self):
+        head = self.get_head()
+        prev = self.__resolved_version
+        if head == prev:
+            return
+        if head is None:
+            resolved = {}
+        elif prev is None:
+            resolved = {}
+            for key, hist in self.__references.items():
+                v = hist.floor(head)
+                if v is not None:
+                    resolved[key] = v
+        else:
+            changed = set()
+            for version in range(min(head, prev) + 1, max(head, prev) + 1):
+                changed.update(self.__version_keys.get(version, ()))
+            resolved = dict(self.__resolved)
+            for key in changed:
+                v = self.__references[key].floor(head)
+                if v is not None:
+                    resolved[key] = v
+                else:
+                    resolved.pop(key, None)
+        self.__resolved = resolved
+        self.__resolved_version = head
+
+    def __resolve(self, version):
+        if version is None or version == self.__resolved_version:
+            return self.__resolved
+        resolved = {}
+        for key, hist in list(self.__references.items()):
+            v = hist.floor(version)
+            if v is not None:
+                resolved[key] = v
+        return resolved
 
     def __getitem__(self, k):
         x = self.get(k)
@@ -74,35 +429,56 @@ class ReplVersionedDict(SyncObjConsumer, Mapping):
         return x
 
     def __len__(self):
-        version = self.get_head()
-        if version in self.__len_cache:
-            return self.__len_cache[version]
-        x = sum([1 for arr in self.__references.values() if self.__floor_to_version(arr, version) is not None])
-        self.__len_cache[version] = x
-        return x
+        return len(self.__resolved)
 
     # https://docs.python.org/3/reference/datamodel.html#object.__iter__
     def __iter__(self):
-        return self.keys()
-
-    # TODO: create ItemsView
-    def items(self) -> ItemsView:
-        version = self.get_head()
-        for key, arr in self.__references.items():
-            v = self.__floor_to_version(arr, version)
+        return iter(self.__resolved)
+
+    # views are backed by the resolved map of a single version, which is never mutated after it is built,
+    # so they are safe to iterate while replicated updates are being applied
+    def snapshot(self, version=None) -> VersionSnapshot:
+        version = self.get_head() if version is None else version
+        return VersionSnapshot(version, self.__resolve(version), self.__get_obj, self.__get_blob)
+
+    # Ordered scans over the key space, e.g.
+    #   scan("interpreter.math.") -> every module under interpreter.math
+    #   scan("/web/") -> every web route
+    # Only keys in the requested range are resolved, so cost is proportional to the size of the subtree.
+    def scan(self, prefix, version=None) -> VersionSnapshot:
+        # smallest string greater than every string starting with prefix
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1) if len(prefix) > 0 and ord(prefix[-1]) < sys.maxunicode else None
+        return self.key_range(start=prefix, end=end, version=version)
+
+    def scan_keys(self, prefix, version=None) -> VersionedKeysView:
+        return VersionedKeysView(self.scan(prefix, version=version))
+
+    # keys in [start, end), either bound may be None.  Only str keys are ordered (keys of any other type can
+    # not be compared with them, and may not be with each other), so other keys are never in a range.
+    def key_range(self, start=None, end=None, version=None) -> VersionSnapshot:
+        version = self.get_head() if version is None else version
+        sorted_keys = self.__sorted_keys
+        lo = 0 if start is None else bisect_left(sorted_keys, start)
+        hi = len(sorted_keys) if end is None else bisect_left(sorted_keys, end)
+        refs = {}
+        for key in sorted_keys[lo:hi]:
+            v = self.__resolve_key(key, version)
             if v is not None:
-                yield key, self.__get_obj(v)
+                refs[key] = v
+        return VersionSnapshot(version, refs, self.__get_obj, self.__get_blob)
 
-    # TODO: create ValuesView
-    def values(self) -> ValuesView:
-        version = self.get_head()
-        for key, arr in self.__references.items():
-            v = self.__floor_to_version(arr, version)
-            if v is not None:
-                yield self.__get_obj(v)
+    # https://stackoverflow.com/questions/42366856/keysview-valuesview-and-itemsview-default-representation-of-a-mapping-subclass
+    def keys(self, version=None) -> VersionedKeysView:
+        return VersionedKeysView(self.snapshot(version))
+
+    def items(self, version=None) -> VersionedItemsView:
+        return VersionedItemsView(self.snapshot(version))
+
+    def values(self, version=None) -> VersionedValuesView:
+        return VersionedValuesView(self.snapshot(version))
 
     def __contains__(self, o: object) -> bool:
-        return self.get(o) is not None
+        return o in self.__resolved
 
     @replicated
     def delete(self, key):
@@ -110,35 +486,74 @@ class ReplVersionedDict(SyncObjConsumer, Mapping):
 
     @replicated
     def __delitem__(self, key):
-        # put a tombstone into the end of the array so that it's ignored in __floor_to_version
+        # put a tombstone into the end of the array so that it's ignored when resolving the key
         self.set(key, None, _doApply=True)
 
-    # https://stackoverflow.com/questions/42366856/keysview-valuesview-and-itemsview-default-representation-of-a-mapping-subclass
-    # TODO: impelement KeysView so it works over BaseManager
-    def keys(self, version=None):
-        version = version or self.get_head()
-        all_keys = []
-        for key, arr in self.__references.items():
-            v = self.__floor_to_version(arr, version)
-            if v is not None:
-                all_keys.append(key)
-        return all_keys.__iter__()
-
     @staticmethod
     def __hash_obj(value):
         m = hashlib.sha256()
         m.update(value)
         return m.digest()
 
-    def __store_obj(self, value):
-        data = dill.dumps(value)
-        key = self.__hash_obj(data)
-        self.__objects[key] = data
-        return key
+    # chunks always carry a codec header, whole pickles only when they are compressed
+    def __encode(self, data, header=False):
+        codec_id = self.__codec_id if len(data) >= self.compress_threshold else BLOB_RAW
+        blob = encode_blob(data, codec_id) if codec_id != BLOB_RAW or header else data
+        if codec_id != BLOB_RAW and len(blob) > len(data):
+            blob = encode_blob(data) if header else data
+        stats = self.__compression_stats
+        stats['blobs'] += 1
+        stats['compressed'] += 1 if blob[0] not in (BLOB_RAW, BLOB_PICKLE) else 0
+        stats['raw_bytes'] += len(data)
+        stats['stored_bytes'] += len(blob)
+        return blob
+
+    def __encode_chunks(self, data):
+        blobs = [self.__encode(c, header=True) for c in chunk_data(data)]
+        return tuple(self.__hash_obj(b) for b in blobs), blobs
+
+    # (content hash, stored blob) of a value, made on the calling node.  Values are stored whole; chunking (a
+    # byte at a time in python) is only done by set_chunked.
+    def __prepare_obj(self, value):
+        if value is None:
+            return None
+        blob = self.__encode(dill.dumps(value))
+        return self.__hash_obj(blob), blob
+
+    def __store_manifest(self, key, chunk_keys):
+        if key in self.__manifests:
+            return
+        self.__manifests[key] = chunk_keys
+        for chunk_key in set(chunk_keys):
+            self.__refcounts[chunk_key] = self.__refcounts.get(chunk_key, 0) + 1
+
+    # the stored form of an object: an (optionally compressed) blob, or the joined data of a chunked value
+    def __get_blob(self, key):
+        blob = self.__objects.get(key)
+        if blob is None:
+            chunk_keys = self.__manifests.get(key)
+            if chunk_keys is not None:
+                chunks = [self.__objects.get(k) for k in chunk_keys]
+                blob = b''.join(decode_blob(c) for c in chunks) if None not in chunks else None
+        return blob
+
+    def __get_data(self, key):
+        blob = self.__get_blob(key)
+        return decode_blob(blob) if blob is not None else None
+
+    def compression_stats(self):
+        stats = dict(self.__compression_stats)
+        stats['ratio'] = stats['raw_bytes'] / stats['stored_bytes'] if stats['stored_bytes'] > 0 else 1.0
+        return stats
 
     def __get_obj(self, key):
-        obj = self.__objects.get(key)
-        return dill.loads(obj) if obj is not None else None
+        data = self.__get_data(key)
+        if data is None:
+            return None
+        return self.__obj_cache.get(key, lambda: (dill.loads(data), len(data)))
+
+    def cache_stats(self):
+        return self.__obj_cache.stats()
 
     def __inc_version(self):
         self.__version = 0 if self.__version is None else self.__version + 1
@@ -147,6 +562,9 @@ class ReplVersionedDict(SyncObjConsumer, Mapping):
     def get_max_version(self):
         return self.__version
 
+    def get_min_version(self):
+        return self.__min_version
+
     @replicated
     def set_head(self, version=None):
         if self.__version is None:
@@ -156,66 +574,958 @@ class ReplVersionedDict(SyncObjConsumer, Mapping):
         else:
             if version is None:
                 version = self.__version
-            self.__head = min(version, self.__version)
+            self.__head = max(min(version, self.__version), self.__min_version or 0)
+            self.__resolve_head()
             if self.on_head_change is not None:
                 self.on_head_change(self.__head)
+            for listener in self.__head_listeners:
+                listener(self.__head)
+
+    # local (not replicated) callbacks invoked with the new head after on_head_change
+    def add_head_change_listener(self, listener):
+        self.__head_listeners = [*self.__head_listeners, listener]
+
+    def remove_head_change_listener(self, listener):
+        self.__head_listeners = [x for x in self.__head_listeners if x is not listener]
 
     def get_head(self):
         return self.__version if self.__head is None else self.__head
 
+    # Values are serialized, compressed and hashed here rather than by every replica, so the log entry carries
+    # the stored blobs and applying it only stores them.  Takes the same keyword arguments as replicated
+    # methods (sync, callback, timeout).
+    def update(self, other, **kwargs):
+        return self.update_blobs({k: self.__prepare_obj(v) for k, v in other.items()}, **kwargs)
+
+    # other: {key: (content hash, blob) or None}, as made by update
     @replicated
-    def update(self, other):
+    def update_blobs(self, other):
         self.__inc_version()
-        for k in other:
-            self.__set(k, other[k])
+        for k, entry in other.items():
+            obj_key = None
+            if entry is not None:
+                obj_key, blob = entry
+                if obj_key not in self.__objects:
+                    self.__objects[obj_key] = blob
+            self.__set_ref(k, obj_key)
+        self.__version_keys[self.__version] = list(other)
         self.set_head(version=None, _doApply=True)
 
-    @staticmethod
-    def __floor_to_version(arr, version):
-        for i in reversed(range(len(arr))):
-            v = arr[i][0]
-            if v <= version:
-                return arr[i][1]
-        return None
+    def get(self, key, version=None):
+        v = self.__resolved.get(key) if version is None else self.__resolve_key(key, version)
+        return self.__get_obj(v) if v is not None else None
+
+    # content hash (hex) of a key at a version, e.g. to check whether a cached value is still current
+    def get_ref(self, key, version=None):
+        v = self.__resolved.get(key) if version is None else self.__resolve_key(key, version)
+        return v.hex() if v is not None else None
+
+    # (content hash, stored blob) of a key at a version, for clients that deserialize values themselves
+    # (see CachedVersionedDict) so the value is neither loaded nor re-pickled here
+    def get_blob(self, key, version=None):
+        v = self.__resolved.get(key) if version is None else self.__resolve_key(key, version)
+        blob = self.__get_blob(v) if v is not None else None
+        return (v.hex(), blob) if blob is not None else None
+
+    # {key: (from hash, to hash)} for every key whose value differs between two versions, with None for
+    # a missing key.  The candidates come from the per-version change log and are resolved against the
+    # per-key version arrays, so the cost is proportional to the number of keys written in between.
+    # A from_version of None diffs against the empty store.  Versions past the newest are clamped to it, and
+    # versions flattened away (below the min version) raise ValueError as their changes are no longer known.
+    def diff(self, from_version, to_version=None):
+        to_version = self.get_head() if to_version is None else to_version
+        if to_version is None or self.__version is None:
+            return {}
+        min_version = self.__min_version or 0
+        for version in (from_version, to_version):
+            if version is not None and version < min_version:
+                raise ValueError(f"version {version} is older than the min version {min_version}")
+        to_version = min(to_version, self.__version)
+        from_version = min(from_version, self.__version) if from_version is not None else None
+        if from_version is None:
+            return {k: (None, v.hex()) for k, v in self.__resolve(to_version).items()}
+        candidates = set()
+        for version in range(min(from_version, to_version) + 1, max(from_version, to_version) + 1):
+            candidates.update(self.__version_keys.get(version, ()))
+        changes = {}
+        for key in sorted(candidates, key=_key_order):
+            a = self.__resolve_key(key, from_version)
+            b = self.__resolve_key(key, to_version)
+            if a != b:
+                changes[key] = (a.hex() if a is not None else None, b.hex() if b is not None else None)
+        return changes
+
+    # the keys of diff() split into (added, changed, removed)
+    def diff_keys(self, from_version, to_version=None):
+        added, changed, removed = [], [], []
+        for key, (a, b) in self.diff(from_version, to_version).items():
+            if a is None:
+                added.append(key)
+            elif b is None:
+                removed.append(key)
+            else:
+                changed.append(key)
+        return added, changed, removed
+
+    def __resolve_key(self, key, version):
+        if version == self.__resolved_version:
+            return self.__resolved.get(key)
+        hist = self.__references.get(key)
+        return hist.floor(version) if hist is not None else None
+
+    def __set_ref(self, key, obj_key):
+        hist = self.__references.get(key)
+        if hist is None:
+            if isinstance(key, str):
+                insort(self.__sorted_keys, key)
+            hist = _KeyHistory()
+            self.__references[key] = hist
+        hist.append(self.__version, obj_key)
+        if obj_key is not None:
+            self.__refcounts[obj_key] = self.__refcounts.get(obj_key, 0) + 1
+
+    def set(self, key, value, **kwargs):
+        return self.update({key: value}, **kwargs)
+
+    # Incremental replication of large values:
+    #   1. the value is serialized and chunked on this node
+    #   2. only the chunks this node does not already hold are replicated, in batches of ~batch_bytes
+    #   3. a small manifest (content hash -> chunk hashes) is committed as a new version
+    # A one byte change to a large artifact therefore replicates a few chunks rather than the whole blob.
+    def set_chunked(self, key, value, timeout=None, batch_bytes=4 * CHUNK_MAX_SIZE, retries=3):
+        data = dill.dumps(value)
+        if len(data) < self.chunk_threshold:
+            return self.set(key, value, sync=True, timeout=timeout)
+        chunk_keys, blobs = self.__encode_chunks(data)
+        by_key = dict(zip(chunk_keys, blobs))
+        for _ in range(retries):
+            batch, batch_size = {}, 0
+            for chunk_key in self.missing_objects(by_key.keys()):
+                batch[chunk_key] = by_key[chunk_key]
+                batch_size += len(batch[chunk_key])
+                if batch_size >= batch_bytes:
+                    self.put_objects(batch, sync=True, timeout=timeout)
+                    batch, batch_size = {}, 0
+            if len(batch) > 0:
+                self.put_objects(batch, sync=True, timeout=timeout)
+            # chunks can be freed by a flatten between the upload and the commit, in which case retry
+            missing = self.update_manifests({key: (self.__hash_obj(data), chunk_keys)}, sync=True, timeout=timeout)
+            if len(missing) == 0:
+                return
+        raise RuntimeError(f"unable to commit chunked value for {key}: {len(missing)} chunks missing")
 
-    def get(self, key):
-        version = self.get_head()
-        arr = self.__references.get(key)
-        if arr is not None:
-            v = self.__floor_to_version(arr, version)
-            if v is not None:
-                return self.__get_obj(v)
-        return None
+    def missing_objects(self, keys):
+        return [k for k in keys if k not in self.__objects]
+
+    # stores blobs without referencing them; they are referenced by a subsequent update_manifests
+    @replicated
+    def put_objects(self, blobs):
+        for key, data in blobs.items():
+            if key not in self.__objects and self.__hash_obj(data) == key:
+                self.__objects[key] = data
 
-    def __set(self, key, value):
-        obj_key = self.__store_obj(value) if value is not None else None
-        arr = self.__references.get(key)
-        if arr is None:
-            arr = []
-        arr.append((self.__version, obj_key))
-        self.__references[key] = arr
+    # other: {key: (content hash, chunk hashes) or None}.  Nothing is applied if any chunk is missing, in
+    # which case the missing chunk hashes are returned.
+    @replicated
+    def update_manifests(self, other):
+        missing = []
+        for manifest in other.values():
+            if manifest is not None:
+                missing.extend(self.missing_objects(manifest[1]))
+        if len(missing) > 0:
+            return missing
+        self.__inc_version()
+        for k, manifest in other.items():
+            obj_key = None
+            if manifest is not None:
+                obj_key, chunk_keys = manifest
+                self.__store_manifest(obj_key, tuple(chunk_keys))
+            self.__set_ref(k, obj_key)
+        self.__version_keys[self.__version] = list(other)
+        self.set_head(version=None, _doApply=True)
+        return missing
 
+    # Collapse all history older than HEAD - retain into a single version and free any object that is
+    # no longer referenced.  HEAD, the `retain` versions before it and any versions newer than HEAD are
+    # kept as-is; set_head can no longer move below the new min version.
     @replicated
-    def set(self, key, value):
-        self.update({key: value}, _doApply=True)
+    def flatten(self, retain=0):
+        head = self.get_head()
+        stats = {'min_version': self.__min_version, 'entries_removed': 0, 'keys_removed': 0,
+                 'objects_freed': 0, 'bytes_reclaimed': 0}
+        if head is None:
+            return stats
+        cutoff = max(head - max(retain, 0), self.__min_version or 0)
+        released = []
+        for key in list(self.__references.keys()):
+            hist = self.__references[key]
+            i = bisect_right(hist.versions, cutoff) - 1
+            if i < 0 or (i == 0 and hist.versions[0] == cutoff):
+                continue
+            # the floor entry at the cutoff stands in for everything before it, unless it is a tombstone
+            floor_key = hist.obj_keys[i]
+            drop = i + 1 if floor_key is None else i
+            released.extend(o for o in hist.obj_keys[:drop] if o is not None)
+            stats['entries_removed'] += drop
+            versions = hist.versions[drop:]
+            obj_keys = hist.obj_keys[drop:]
+            if floor_key is not None:
+                versions[0] = cutoff
+            if len(versions) == 0:
+                del self.__references[key]
+                stats['keys_removed'] += 1
+            else:
+                self.__references[key] = _KeyHistory(versions, obj_keys)
+
+        for obj_key in released:
+            self.__refcounts[obj_key] -= 1
+        for obj_key in [k for k in self.__manifests.keys() if self.__refcounts.get(k, 0) <= 0]:
+            for chunk_key in set(self.__manifests.pop(obj_key)):
+                self.__refcounts[chunk_key] -= 1
+            self.__refcounts.pop(obj_key, None)
+            self.__obj_cache.discard(obj_key)
+        for obj_key in [k for k in self.__objects.keys() if self.__refcounts.get(k, 0) <= 0]:
+            stats['bytes_reclaimed'] += len(self.__objects.pop(obj_key))
+            stats['objects_freed'] += 1
+            self.__refcounts.pop(obj_key, None)
+            self.__obj_cache.discard(obj_key)
+
+        self.__min_version = cutoff
+        stats['min_version'] = cutoff
+        self.__rebuild_indexes()
+        self.__last_flatten = stats
+        return stats
+
+    def stats(self):
+        return {
+            'keys': len(self.__resolved),
+            'history_entries': sum(len(hist) for hist in self.__references.values()),
+            'objects': len(self.__objects),
+            'manifests': len(self.__manifests),
+            'object_bytes': sum(len(data) for data in self.__objects.values()),
+            'head': self.get_head(),
+            'min_version': self.__min_version,
+            'max_version': self.__version,
+            'last_flatten': self.__last_flatten,
+            'cache': self.__obj_cache.stats(),
+            'compression': self.compression_stats(),
+        }
+
+
+# Client side read cache for a ReplVersionedDict proxy (e.g. m.repl_code_store()).
+#   Values are cached by content hash, and the hash of each key read is remembered for the HEAD it was read
+#   at.  A read first checks HEAD (at most once every max_staleness seconds); when HEAD has moved, the store is
+#   asked which keys changed in between and only those hashes are replaced, so unchanged keys stay hits and a
+#   key changed back to an earlier value is a hit as well.  Misses fetch the stored blob, which is deserialized
+#   here rather than loaded and re-pickled by the server.  Values are shared between readers, so callers should
+#   not mutate them.  Other methods are passed through to the store.
+#   ex usage:
+#       store = CachedVersionedDict(m.repl_code_store())
+#       src = store.get("my_lambda")
+class CachedVersionedDict:
+
+    def __init__(self, store, max_entries=1024, max_bytes=64 * 1024 * 1024, max_staleness=0.0):
+        self.store = store
+        self.max_staleness = max_staleness
+        self.__values = _ObjectCache(max_entries=max_entries, max_bytes=max_bytes)
+        self.__lock = threading.Lock()
+        self.__head = None
+        self.__checked = 0
+        # key -> content hash at __head, None for keys missing at __head
+        self.__refs = {}
+        self.head_checks = 0
+        self.head_changes = 0
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    def get_head(self):
+        if self.max_staleness > 0 and time.time() - self.__checked < self.max_staleness:
+            return self.__head
+        checked = time.time()
+        head = self.store.get_head()
+        with self.__lock:
+            self.head_checks += 1
+            if head != self.__head:
+                self.__advance(head)
+            self.__checked = checked
+        return head
+
+    def __advance(self, head):
+        refs = {}
+        old = self.__head
+        if old is not None and head is not None and len(self.__refs) > 0:
+            # changes before the store's min version were flattened away, so diff cannot account for them
+            if old >= (self.store.get_min_version() or 0):
+                refs = dict(self.__refs)
+                for key, (_, ref) in self.store.diff(old, head).items():
+                    if key in refs:
+                        refs[key] = ref
+        self.__refs = refs
+        self.__head = head
+        self.head_changes += 1
+
+    def __load(self, entry):
+        ref, blob = entry
+        return self.__values.get(ref, lambda: (dill.loads(decode_blob(blob)), len(blob)))
+
+    def get(self, key, version=None):
+        if version is not None:
+            ref = self.store.get_ref(key, version=version)
+            if ref is None:
+                return None
+            return self.__values.get(ref, lambda: self.__fetch(key, version))
+        head = self.get_head()
+        with self.__lock:
+            known = self.__head == head and key in self.__refs
+            ref = self.__refs.get(key) if known else None
+        if known:
+            return self.__values.get(ref, lambda: self.__fetch(key, head)) if ref is not None else None
+        entry = self.store.get_blob(key, version=head)
+        with self.__lock:
+            if self.__head == head:
+                self.__refs[key] = entry[0] if entry is not None else None
+        return self.__load(entry) if entry is not None else None
+
+    def __fetch(self, key, version):
+        entry = self.store.get_blob(key, version=version)
+        if entry is None:
+            raise KeyError(f"{key} is not in version {version}")
+        _, blob = entry
+        return dill.loads(decode_blob(blob)), len(blob)
+
+    def __getitem__(self, k):
+        x = self.get(k)
+        if x is None:
+            raise KeyError(k)
+        return x
+
+    def __contains__(self, k):
+        return self.get(k) is not None
+
+    def invalidate(self):
+        with self.__lock:
+            self.__refs = {}
+            self.__head = None
+            self.__checked = 0
+        self.__values.clear()
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'head': self.__head,
+                'keys': len(self.__refs),
+                'head_checks': self.head_checks,
+                'head_changes': self.head_changes,
+                'cache': self.__values.stats(),
+            }
+
+
+# Results of tasks keyed by task id, so callers on any node can fetch or wait for them.
+#   Entries expire ttl seconds after they are written and the oldest are evicted beyond max_entries or
+#   max_bytes (measured as the pickled size of the result).  Expiry is driven by the timestamp carried in each
+#   command rather than the local clock so every replica evicts the same entries.
+#   ex usage:
+#       task_id = repl_tasks.submit("my_lambda", 1, 2)
+#       result, error = repl_results.wait(task_id, timeout=10)
+class ReplResultStore(SyncObjConsumer):
+
+    def __init__(self, ttl=3600, max_entries=10000, max_bytes=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.__cond = threading.Condition()
+        super(ReplResultStore, self).__init__()
+        # task_id -> (result, error, expires, size)
+        self.__results = OrderedDict()
+        self.__bytes = 0
+
+    def put(self, task_id, result, error=None, ttl=None, callback=None, sync=False, timeout=None):
+        return self.set(task_id, result, error, time.time(), ttl, callback=callback, sync=sync, timeout=timeout)
 
     @replicated
-    def flatten(self):
-        pass
+    def set(self, task_id, result, error, timestamp, ttl=None):
+        self.__evict(timestamp)
+        size = len(dill.dumps(result)) if self.max_bytes is not None else 0
+        self.__discard(task_id)
+        self.__results[task_id] = (result, error, timestamp + (ttl or self.ttl), size)
+        self.__bytes += size
+        while len(self.__results) > self.max_entries or \
+                (self.max_bytes is not None and self.__bytes > self.max_bytes and len(self.__results) > 1):
+            self.__discard(next(iter(self.__results)))
+        with self.__cond:
+            self.__cond.notify_all()
+
+    @replicated
+    def delete(self, task_id):
+        self.__discard(task_id)
+
+    def __discard(self, task_id):
+        entry = self.__results.pop(task_id, None)
+        if entry is not None:
+            self.__bytes -= entry[3]
+
+    # entries are in write order, so with a uniform ttl the expired ones are all at the front; entries with a
+    # shorter ttl than their predecessors linger until those go, but get() never returns them
+    def __evict(self, timestamp):
+        while len(self.__results) > 0:
+            k, v = next(iter(self.__results.items()))
+            if v[2] > timestamp:
+                break
+            self.__discard(k)
+
+    def _deserialize(self, data):
+        super()._deserialize(data)
+        with self.__cond:
+            self.__cond.notify_all()
+
+    # (result, error) of the task, None if unknown or expired
+    def get(self, task_id):
+        entry = self.__results.get(task_id)
+        if entry is None or entry[2] <= time.time():
+            return None
+        return entry[0], entry[1]
+
+    def __contains__(self, task_id):
+        return self.get(task_id) is not None
+
+    # blocks until the result is written, returning None if timeout expires first
+    def wait(self, task_id, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.__cond:
+            while True:
+                entry = self.get(task_id)
+                if entry is not None:
+                    return entry
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.__cond.wait(remaining)
+
+    async def wait_async(self, task_id, timeout=None):
+        return await asyncio.get_running_loop().run_in_executor(None, self.wait, task_id, timeout)
+
+    def stats(self):
+        return {
+            'entries': len(self.__results),
+            'bytes': self.__bytes
+        }
+
+
+def _result_error(result):
+    return (None, repr(result)) if isinstance(result, Exception) else (result, None)
 
 
 class ReplTaskManager(SyncObjConsumer):
 
-    def __init__(self, kvstore, task_manager):
+    def __init__(self, kvstore, task_manager, results=None):
         self.kvstore = kvstore
         self.task_manager = task_manager
+        self.results = results
         super(ReplTaskManager, self).__init__()
 
-    # TODO: we should provide another way to store results as replicated actions would all store into the same key
+    # every replica runs the lambda, so results written this way would all collide: use submit to get them
     @replicated
     def apply(self, src, *args, **kwargs):
         return self.task_manager.apply(src, *args, **kwargs)
 
+    # Runs the lambda on every replica like apply, with each replica recording its own (identical, for a
+    #   deterministic lambda) result in the results store locally instead of replicating it again.
+    def submit(self, src, *args, **kwargs):
+        task_id = str(uuid.uuid4())
+        self.apply_result(task_id, time.time(), src, *args, **kwargs)
+        return task_id
+
+    @replicated
+    def apply_result(self, task_id, timestamp, src, *args, **kwargs):
+        result = self.task_manager.apply(src, *args, **kwargs)
+        if self.results is not None:
+            result, error = _result_error(result)
+            self.results.set(task_id, result, error, timestamp, _doApply=True)
+        return result
+
+    # one log entry for the whole batch rather than one per item
+    @replicated
+    def apply_many(self, src, iterable, chunk_size=1000, workers=1):
+        return self.task_manager.apply_many(src, iterable, chunk_size=chunk_size, workers=workers)
+
+
+# Runs each submitted task on exactly one node, unlike ReplTaskManager.apply which runs on every replica.
+#   Submissions go through the log, the leader places each task on the least loaded live host (hosts is the
+#   repl_hosts lock manager) whose HostResources have capacity for the task's HostRequirements and replicates
+#   the assignment, and only the assigned node executes it (once it has caught up with the log) and replicates
+#   the outcome.  When a host's lock expires its tasks are placed again, up to max_attempts; the attempt
+#   number fences off late completions.
+#   ex usage:
+#       task_id = repl_scheduler.submit("my_lambda", args=(1, 2), requirements=HostRequirements(None, None, None))
+#       repl_scheduler.status(task_id)
+class ReplTaskScheduler(SyncObjConsumer):
+
+    def __init__(self, hosts, task_manager, results=None, poll_interval=0.5, max_attempts=3, max_finished=1000):
+        self.hosts = hosts
+        self.task_manager = task_manager
+        self.results = results
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.max_finished = max_finished
+        self.__executing = set()
+        # (task id, attempt) of the assigned tasks this node has started
+        self.__started = set()
+        self.__proposed = dict()
+        self.__destroying = False
+        self.__thread = threading.Thread(target=self.__schedule_loop, daemon=True)
+        super(ReplTaskScheduler, self).__init__()
+        self.__tasks = OrderedDict()
+        self.__finished = OrderedDict()
+        self.__thread.start()
+
+    def destroy(self):
+        self.__destroying = True
+
+    def __self_id(self):
+        return self._syncObj.selfNode.id if self._syncObj is not None else None
+
+    def __schedule_loop(self):
+        while not self.__destroying:
+            time.sleep(self.poll_interval)
+            if self._syncObj is None:
+                continue
+            try:
+                self.__run_assigned()
+                if self._syncObj._isLeader():
+                    self.__schedule()
+            except Exception as e:
+                print(e)
+
+    # Assigned tasks are started here rather than when the assignment is applied, and only once this node has
+    # applied everything it knows to be committed: a node catching up, e.g. replaying the log after a restart,
+    # applies the assignments of tasks it already ran before the completions that follow them.
+    def __run_assigned(self):
+        so = self._syncObj
+        if not so._isReady() or so.raftLastApplied < so.raftCommitIndex:
+            return
+        self_id = self.__self_id()
+        assigned = set()
+        for task_id, task in list(self.__tasks.items()):
+            if task['host'] != self_id:
+                continue
+            key = (task_id, task['attempt'])
+            assigned.add(key)
+            if key not in self.__started:
+                self.__execute(key, task)
+        self.__started = assigned
+
+    def __schedule(self):
+        now = time.time()
+        hosts = {k: v for k, v in self.hosts.lockData().items() if self.hosts.isOwned(k)}
+        tasks = list(self.__tasks.items())
+        load = dict()
+        for _, task in tasks:
+            if task['host'] in hosts:
+                load[task['host']] = load.get(task['host'], 0) + 1
+        for task_id, task in tasks:
+            if task['host'] in hosts:
+                continue
+            # the previous proposal may still be in flight
+            if now - self.__proposed.get(task_id, 0) < self.poll_interval * 4:
+                continue
+            self.__proposed[task_id] = now
+            if task['attempt'] >= self.max_attempts:
+                self.complete(task_id, task['attempt'], None, f"task not completed after {task['attempt']} attempts",
+                              now)
+                continue
+            host_id = self.place(task['requirements'], hosts, load)
+            if host_id is not None:
+                load[host_id] = load.get(host_id, 0) + 1
+                self.assign(task_id, host_id, task['attempt'])
+        for task_id in [k for k in self.__proposed if k not in self.__tasks]:
+            del self.__proposed[task_id]
+
+    # least loaded host with capacity for the requirements, ties broken by id so placement is stable
+    @staticmethod
+    def place(requirements, hosts, load=None):
+        load = load or {}
+        candidates = [k for k, v in hosts.items() if requirements is None or v.has_capacity(requirements)]
+        return min(candidates, key=lambda k: (load.get(k, 0), k), default=None)
+
+    def submit(self, src, args=(), kwargs=None, requirements=None, task_id=None,
+               callback=None, sync=False, timeout=None):
+        task_id = task_id or str(uuid.uuid4())
+        self.enqueue(task_id, src, tuple(args), kwargs or {}, requirements,
+                     callback=callback, sync=sync, timeout=timeout)
+        return task_id
+
+    @replicated
+    def enqueue(self, task_id, src, args, kwargs, requirements):
+        if task_id in self.__tasks or task_id in self.__finished:
+            return False
+        self.__tasks[task_id] = {
+            'src': src,
+            'args': args,
+            'kwargs': kwargs,
+            'requirements': requirements,
+            'host': None,
+            'attempt': 0
+        }
+        return True
+
+    @replicated
+    def assign(self, task_id, host_id, attempt):
+        task = self.__tasks.get(task_id)
+        if task is None or task['attempt'] != attempt:
+            return False
+        task['host'] = host_id
+        task['attempt'] = attempt + 1
+        return True
+
+    @replicated
+    def complete(self, task_id, attempt, result, error, timestamp):
+        task = self.__tasks.get(task_id)
+        if task is None or task['attempt'] != attempt:
+            return False
+        del self.__tasks[task_id]
+        if self.results is not None:
+            self.results.set(task_id, result, error, timestamp, _doApply=True)
+            result = None
+        self.__finished[task_id] = {'host': task['host'], 'attempt': attempt, 'result': result, 'error': error}
+        while len(self.__finished) > self.max_finished:
+            self.__finished.popitem(last=False)
+        return True
+
+    def __execute(self, key, task):
+        self.__started.add(key)
+        self.__executing.add(key)
+        threading.Thread(target=self.__run, daemon=True,
+                         args=(key, task['src'], task['args'], task['kwargs'])).start()
+
+    def __run(self, key, src, args, kwargs):
+        task_id, attempt = key
+        result, error = None, None
+        try:
+            result, error = _result_error(self.task_manager.apply_async(src, *args, **kwargs).result())
+        except Exception as e:
+            print(e)
+            error = repr(e)
+        try:
+            for _ in range(3):
+                try:
+                    self.complete(task_id, attempt, result, error, time.time(),
+                                  sync=True, timeout=self.poll_interval * 10)
+                    return
+                except SyncObjException as e:
+                    print(e)
+                except Exception as e:
+                    # most likely an unpicklable result, which is reported as the task's error instead
+                    result, error = None, repr(e)
+        finally:
+            self.__executing.discard(key)
+
+    def status(self, task_id):
+        task = self.__tasks.get(task_id)
+        if task is not None:
+            return {'state': 'pending' if task['host'] is None else 'assigned',
+                    'host': task['host'],
+                    'attempt': task['attempt']}
+        finished = self.__finished.get(task_id)
+        if finished is not None:
+            return {'state': 'failed' if finished['error'] is not None else 'done',
+                    'host': finished['host'],
+                    'attempt': finished['attempt']}
+        return None
+
+    # (result, error) of a finished task, None if it is unknown or still running
+    def result(self, task_id):
+        if self.results is not None:
+            return self.results.get(task_id)
+        finished = self.__finished.get(task_id)
+        return (finished['result'], finished['error']) if finished is not None else None
+
+    def wait(self, task_id, timeout=None):
+        if self.results is None:
+            raise RuntimeError("waiting for results requires a result store")
+        return self.results.wait(task_id, timeout=timeout)
+
+    def pending(self):
+        return [k for k, v in self.__tasks.items() if v['host'] is None]
+
+    def stats(self):
+        hosts = dict()
+        for task in list(self.__tasks.values()):
+            if task['host'] is not None:
+                hosts[task['host']] = hosts.get(task['host'], 0) + 1
+        return {
+            'pending': len(self.pending()),
+            'assigned': hosts,
+            'finished': len(self.__finished),
+            'executing': len(self.__executing)
+        }
+
+
+_CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+
+def _parse_cron_field(field, lo, hi):
+    values = set()
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        if part == '*':
+            start, end = lo, hi
+        elif '-' in part:
+            start, end = (int(x) for x in part.split('-'))
+        else:
+            start = int(part)
+            end = hi if step else start
+        if start < lo or end > hi + (1 if hi == 6 else 0) or start > end:
+            raise ValueError(f"cron field out of range: {field}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+
+# 5 field cron expression (minute hour day-of-month month day-of-week), evaluated in UTC so every node agrees
+class CronSchedule:
+
+    def __init__(self, expr):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError(f"expected 5 cron fields: {expr}")
+        self.expr = expr
+        self.minutes, self.hours, self.days, self.months, dow = \
+            (_parse_cron_field(f, lo, hi) for f, (lo, hi) in zip(fields, _CRON_RANGES))
+        # 7 is also sunday
+        self.weekdays = {x % 7 for x in dow}
+        # as in cron, when both day fields are restricted a day matching either one fires
+        self.__any_day = fields[2] == '*' or fields[4] == '*'
+
+    def __day_matches(self, t):
+        dom = t.tm_mday in self.days
+        dow = (t.tm_wday + 1) % 7 in self.weekdays
+        return (dom and dow) if self.__any_day else (dom or dow)
+
+    # first fire time strictly after the given timestamp
+    def next(self, after):
+        ts = (int(after) // 60 + 1) * 60
+        limit = ts + 5 * 366 * 86400
+        while ts < limit:
+            t = time.gmtime(ts)
+            if t.tm_mon not in self.months or not self.__day_matches(t):
+                ts = calendar.timegm((t.tm_year, t.tm_mon, t.tm_mday, 0, 0, 0)) + 86400
+            elif t.tm_hour not in self.hours:
+                ts = calendar.timegm((t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, 0, 0)) + 3600
+            elif t.tm_min not in self.minutes:
+                ts += 60
+            else:
+                return ts
+        return None
+
+
+# Replicated table of periodic jobs: schedule is a cron expression or an interval in seconds.
+#   Only the leader evaluates the table, proposing fire(name, fire_time) when a job is due; the log dedupes on
+#   the job's last_run, so each fire time runs once cluster-wide even across leader changes.  The accepted
+#   fire is enqueued on the ReplTaskScheduler (task id "<name>@<fire_time>", placed by the job's requirements),
+#   which runs it on exactly one node; nothing runs as a side effect of applying the log, which is replayed by
+#   nodes catching up.  Runs missed while there was no leader are coalesced into one.
+#   ex usage:
+#       repl_cron.add("cleanup", "*/15 * * * *", "jobs.cleanup")
+#       repl_cron.add("heartbeat", 30, "jobs.heartbeat", args=("ping",))
+class ReplCronScheduler(SyncObjConsumer):
+
+    def __init__(self, scheduler, poll_interval=1.0):
+        if scheduler is None:
+            raise ValueError("a ReplTaskScheduler is required to run cron jobs")
+        self.scheduler = scheduler
+        self.poll_interval = poll_interval
+        self.__schedules = dict()
+        self.__proposed = dict()
+        self.__destroying = False
+        self.__thread = threading.Thread(target=self.__fire_loop, daemon=True)
+        super(ReplCronScheduler, self).__init__()
+        self.__jobs = dict()
+        self.__thread.start()
+
+    def destroy(self):
+        self.__destroying = True
+
+    def __schedule(self, schedule):
+        if isinstance(schedule, (int, float)):
+            return None
+        cron = self.__schedules.get(schedule)
+        if cron is None:
+            cron = CronSchedule(schedule)
+            self.__schedules[schedule] = cron
+        return cron
+
+    def __next_fire(self, job, now):
+        last_run = job['last_run']
+        if isinstance(job['schedule'], (int, float)):
+            every = job['schedule']
+            due = last_run + every
+            return due + ((now - due) // every) * every if due <= now else due
+        cron = self.__schedule(job['schedule'])
+        due = cron.next(last_run)
+        while due is not None:
+            following = cron.next(due)
+            if following is None or following > now:
+                break
+            due = following
+        return due
+
+    def add(self, name, schedule, src, args=(), kwargs=None, requirements=None,
+            callback=None, sync=False, timeout=None):
+        self.__schedule(schedule)
+        return self.set_job(name, schedule, src, tuple(args), kwargs or {}, requirements, time.time(),
+                            callback=callback, sync=sync, timeout=timeout)
+
+    @replicated
+    def set_job(self, name, schedule, src, args, kwargs, requirements, timestamp):
+        job = self.__jobs.get(name)
+        self.__jobs[name] = {
+            'schedule': schedule,
+            'src': src,
+            'args': args,
+            'kwargs': kwargs,
+            'requirements': requirements,
+            'enabled': True,
+            'last_run': job['last_run'] if job is not None else timestamp,
+            'runs': job['runs'] if job is not None else 0,
+            'last_task_id': job['last_task_id'] if job is not None else None
+        }
+
+    @replicated
+    def remove(self, name):
+        return self.__jobs.pop(name, None) is not None
+
+    @replicated
+    def enable(self, name, enabled=True):
+        job = self.__jobs.get(name)
+        if job is not None:
+            job['enabled'] = enabled
+
+    @replicated
+    def fire(self, name, fire_time):
+        job = self.__jobs.get(name)
+        if job is None or fire_time <= job['last_run']:
+            return False
+        task_id = f"{name}@{fire_time}"
+        job['last_run'] = fire_time
+        job['runs'] += 1
+        job['last_task_id'] = task_id
+        self.scheduler.enqueue(task_id, job['src'], job['args'], job['kwargs'], job['requirements'], _doApply=True)
+        return True
+
+    def __fire_loop(self):
+        while not self.__destroying:
+            time.sleep(self.poll_interval)
+            if self._syncObj is None or not self._syncObj._isLeader():
+                continue
+            now = time.time()
+            for name, job in list(self.__jobs.items()):
+                if not job['enabled']:
+                    continue
+                try:
+                    due = self.__next_fire(job, now)
+                except Exception as e:
+                    print(e)
+                    continue
+                if due is None or due > now or self.__proposed.get(name) == due:
+                    continue
+                self.__proposed[name] = due
+                self.fire(name, due)
+
+    def get_job(self, name):
+        job = self.__jobs.get(name)
+        if job is None:
+            return None
+        return {**job, 'next_run': self.__next_fire(job, job['last_run'])}
+
+    def jobs(self):
+        return {k: self.get_job(k) for k in list(self.__jobs.keys())}
+
+
+# Replicated queue split into a fixed number of partitions, each consumed by a single node.
+#   Items go to a partition by a stable hash of their key and partitions are spread over the live nodes with
+#   capacity for requirements (all live nodes if None) by the consistent hash ring from get_partition_ring
+#   (push_server supplies it as get_ring, which is called with the requirements), so membership changes only
+#   move the partitions adjacent to the joining or leaving node.  Consumers poll() the partitions
+#   they own and ack() an offset once the items up to it are processed; unacked items are redelivered to
+#   whichever node owns the partition next.
+#   ex usage:
+#       repl_queue.put("user:1", {"event": "click"})
+#       for partition, items in repl_queue.poll().items():
+#           ...
+#           repl_queue.ack(partition, items[-1][0])
+class ReplPartitionedQueue(SyncObjConsumer):
+
+    def __init__(self, partitions=64, get_ring=None, max_size=None, requirements=None):
+        self.partitions = partitions
+        self.get_ring = get_ring
+        self.max_size = max_size
+        self.requirements = requirements
+        super(ReplPartitionedQueue, self).__init__()
+        self.__queues = [deque() for _ in range(partitions)]
+        self.__offsets = [0] * partitions
+
+    @staticmethod
+    def partition_of(key, partitions):
+        return int.from_bytes(hashlib.blake2b(str(key).encode('utf8'), digest_size=8).digest(), 'big') % partitions
+
+    def __put(self, key, item):
+        p = ReplPartitionedQueue.partition_of(key, self.partitions)
+        q = self.__queues[p]
+        if self.max_size is not None and len(q) >= self.max_size:
+            return None
+        offset = self.__offsets[p]
+        self.__offsets[p] = offset + 1
+        q.append((offset, item))
+        return p, offset
+
+    # (partition, offset) of the item, or None if the partition is full
+    @replicated
+    def put(self, key, item):
+        return self.__put(key, item)
+
+    @replicated
+    def put_many(self, items):
+        return [self.__put(key, item) for key, item in items]
+
+    # drop the items of a partition up to and including offset
+    @replicated
+    def ack(self, partition, offset):
+        q = self.__queues[partition]
+        while len(q) > 0 and q[0][0] <= offset:
+            q.popleft()
+
+    def peek(self, partition, max_items=None):
+        q = self.__queues[partition]
+        return list(q) if max_items is None else [q[i] for i in range(min(max_items, len(q)))]
+
+    def owner(self, partition):
+        return self.get_ring(self.requirements).node_for(partition)
+
+    def owned_partitions(self, node_id=None):
+        if node_id is None:
+            node_id = self._syncObj.selfNode.id
+        return self.get_ring(self.requirements).partitions(node_id, self.partitions)
+
+    # {partition: [(offset, item), ...]} for the non-empty partitions owned by node_id (default this node)
+    def poll(self, max_items=100, node_id=None):
+        result = dict()
+        for p in self.owned_partitions(node_id):
+            if len(self.__queues[p]) > 0:
+                result[p] = self.peek(p, max_items)
+        return result
+
+    def __len__(self):
+        return sum(len(q) for q in self.__queues)
+
+    def stats(self):
+        return {
+            'partitions': self.partitions,
+            'size': len(self),
+            'depths': {p: len(q) for p, q in enumerate(self.__queues) if len(q) > 0}
+        }
+
 
 # Similar to _ReplLockManagerImpl but supports data bound to the lock
 # TODO: can this be done with a lock and the dict?
@@ -0,0 +1,181 @@
+import mmap
+import os
+import tempfile
+import threading
+
+# Node-local store for bulk data, e.g. large arrays and datasets that lambdas process on this node.
+#
+# Blobs are files under the store's directory, mapped into memory, so nothing is replicated through raft and a
+# blob is never held as one pickled message.  Clients upload over the manager connection in chunks: each chunk is
+# a memoryview slice of the source, which the 'push' serializer sends out-of-band (see send_framed), and which the
+# server writes straight into the blob's mapping.  Reads return memoryviews of the mapping, so downloads are sent
+# from the mapping as-is.
+#
+#   ex usage:
+#       (client)
+#           blobs = m.local_blobs()
+#           upload(blobs, "points", np.random.rand(10_000_000))
+#       (lambda on the node)
+#           points = np.frombuffer(local_blobs.view("points"))
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class _Upload:
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.file = open(path, "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size) if size > 0 else None
+        self.written = 0
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.file.close()
+
+
+class LocalBlobStore:
+
+    def __init__(self, root=None):
+        self.root = root or tempfile.mkdtemp(prefix="push-blobs-")
+        os.makedirs(self.root, exist_ok=True)
+        self.__uploads = dict()
+        self.__maps = dict()
+        self.__lock = threading.Lock()
+
+    def path(self, name):
+        if len(name) == 0 or os.path.basename(name) != name or name.startswith('.'):
+            raise ValueError(f"invalid blob name: {name}")
+        return os.path.join(self.root, name)
+
+    # starts an upload of size bytes, replacing any upload of the same name in progress; the blob becomes
+    # visible (replacing an existing one) when sealed
+    def create(self, name, size):
+        path = self.path(name)
+        upload = _Upload(f"{path}.part", size)
+        with self.__lock:
+            previous = self.__uploads.pop(name, None)
+            self.__uploads[name] = upload
+        if previous is not None:
+            previous.close()
+
+    def write(self, name, offset, data):
+        upload = self.__uploads.get(name)
+        if upload is None:
+            raise KeyError(f"no upload in progress: {name}")
+        data = memoryview(data).cast('B')
+        end = offset + data.nbytes
+        if offset < 0 or end > upload.size:
+            raise ValueError(f"write [{offset}, {end}) is outside blob {name} of size {upload.size}")
+        if data.nbytes > 0:
+            upload.map[offset:end] = data
+        upload.written += data.nbytes
+        return end
+
+    def seal(self, name):
+        with self.__lock:
+            upload = self.__uploads.pop(name, None)
+        if upload is None:
+            raise KeyError(f"no upload in progress: {name}")
+        upload.close()
+        os.replace(upload.path, self.path(name))
+        self.__drop_map(name)
+        return upload.size
+
+    def abort(self, name):
+        with self.__lock:
+            upload = self.__uploads.pop(name, None)
+        if upload is not None:
+            upload.close()
+            os.remove(upload.path)
+
+    def __drop_map(self, name):
+        with self.__lock:
+            m = self.__maps.pop(name, None)
+        if m is not None:
+            try:
+                m.close()
+            except BufferError:
+                # views of it are still in use, it is unmapped once they are released
+                pass
+
+    # read only mapping of the blob, shared by all callers on this node
+    def open(self, name):
+        m = self.__maps.get(name)
+        if m is not None:
+            return m
+        path = self.path(name)
+        with self.__lock:
+            m = self.__maps.get(name)
+            if m is None:
+                with open(path, "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size > 0 else b""
+                self.__maps[name] = m
+        return m
+
+    def view(self, name):
+        return memoryview(self.open(name))
+
+    def read(self, name, offset=0, size=None):
+        v = self.view(name)
+        return v[offset:] if size is None else v[offset:offset + size]
+
+    def size(self, name):
+        return os.path.getsize(self.path(name))
+
+    def delete(self, name):
+        path = self.path(name)
+        self.__drop_map(name)
+        if os.path.exists(path):
+            os.remove(path)
+            return True
+        return False
+
+    def keys(self):
+        return [x for x in sorted(os.listdir(self.root)) if not x.endswith(".part")]
+
+    def __contains__(self, name):
+        return os.path.exists(self.path(name))
+
+    def stats(self):
+        keys = self.keys()
+        return {
+            "root": self.root,
+            "count": len(keys),
+            "bytes": sum(self.size(x) for x in keys),
+            "uploads": {k: (v.written, v.size) for k, v in self.__uploads.items()},
+        }
+
+
+# Uploads data (anything exposing a contiguous buffer: bytes, memoryview, array, numpy arrays, mmaps, ...) to the
+# blob store behind blobs, which is usually a proxy, one chunk at a time without copying data.
+def upload(blobs, name, data, chunk_size=DEFAULT_CHUNK_SIZE):
+    data = memoryview(data).cast('B')
+    blobs.create(name, data.nbytes)
+    try:
+        for offset in range(0, data.nbytes, chunk_size):
+            blobs.write(name, offset, data[offset:offset + chunk_size])
+    except BaseException:
+        try:
+            blobs.abort(name)
+        except Exception:
+            pass
+        raise
+    return blobs.seal(name)
+
+
+# Downloads a blob into out (a writable buffer of at least the blob's size), or into a new bytearray.
+def download(blobs, name, out=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    size = blobs.size(name)
+    if out is None:
+        out = bytearray(size)
+    target = memoryview(out).cast('B')
+    for offset in range(0, size, chunk_size):
+        chunk = blobs.read(name, offset, chunk_size)
+        target[offset:offset + len(chunk)] = chunk
+    return out
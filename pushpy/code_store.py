@@ -1,13 +1,18 @@
 from __future__ import print_function
 
+import hashlib
+import importlib.util
 import io
 import json
+import marshal
 import os
 import sys
+import threading
 import types
 import typing
 import uuid
 import zipfile
+from collections import OrderedDict
 from importlib.abc import Loader as _Loader, MetaPathFinder as _MetaPathFinder
 from importlib.machinery import ModuleSpec
 from json import JSONDecodeError
@@ -100,6 +105,97 @@ def load_url_text(u):
         return f.text
 
 
+# Compiled code objects keyed by a hash of the source (and filename / interpreter magic), so reloading
+# modules after a HEAD change, or switching HEAD back, reuses bytecode instead of recompiling.  If cache_dir
+# is set, code objects are also marshalled to disk (like __pycache__) so a restarted node can reuse them.
+class BytecodeCache:
+
+    def __init__(self, cache_dir=None, max_entries=4096):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def __key(source, filename, mode):
+        m = hashlib.sha256(importlib.util.MAGIC_NUMBER)
+        m.update(f"{filename}\0{mode}\0".encode('utf8'))
+        m.update(source.encode('utf8') if isinstance(source, str) else source)
+        return m.hexdigest()
+
+    def compile(self, source, filename, mode='exec'):
+        key = self.__key(source, filename, mode)
+        with self.__lock:
+            co = self.__entries.get(key)
+            if co is not None:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return co
+        co = self.__read(key)
+        if co is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            co = compile(source, filename, mode)
+            self.__write(key, co)
+        with self.__lock:
+            self.__entries[key] = co
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+        return co
+
+    def __path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pushc")
+
+    def __read(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self.__path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        magic = importlib.util.MAGIC_NUMBER
+        if not data.startswith(magic):
+            return None
+        try:
+            return marshal.loads(data[len(magic):])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def __write(self, key, co):
+        if self.cache_dir is None:
+            return
+        try:
+            ensure_path(self.cache_dir)
+            tmp_path = f"{self.__path(key)}.{uuid.uuid4()}"
+            with open(tmp_path, "wb") as f:
+                f.write(importlib.util.MAGIC_NUMBER)
+                f.write(marshal.dumps(co))
+            os.replace(tmp_path, self.__path(key))
+        except OSError as e:
+            print(f"BytecodeCache: unable to write {key}: {e}")
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        return {
+            'entries': len(self.__entries),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'cache_dir': self.cache_dir,
+        }
+
+
+bytecode_cache = BytecodeCache()
+
+
 class ValueLoader(_Loader):
 
     def __init__(self, fullname, name, value):
@@ -123,7 +219,7 @@ class ValueLoader(_Loader):
         elif isinstance(v, types.CodeType):
             exec(v, module.__dict__)
         elif isinstance(v, str):
-            v = compile(v, self.name, 'exec')
+            v = bytecode_cache.compile(v, self.name, 'exec')
             exec(v, module.__dict__)
         elif isinstance(v, dict):
             sub_mod_fullname = f"{self.fullname}.{k}"
@@ -155,19 +251,34 @@ class DictFinder(_MetaPathFinder):
     def __init__(self, store):
         self.store = store
         self.cache_store = None
+        self.version = None
         self.__build_key_cache()
 
     def find_module(self, fullname, path):
         return self.find_spec(fullname, path)
 
     def __build_key_cache(self):
-        self.cache_store = packages_to_dict(self.store)
-        show_dict(self.cache_store)
+        self.version = self.store.get_head() if hasattr(self.store, 'get_head') else None
+        if hasattr(self.store, 'scan'):
+            # package trees are pulled from the store on first import of each top level package
+            self.cache_store = {}
+        else:
+            self.cache_store = packages_to_dict(self.store)
+            show_dict(self.cache_store)
+
+    def __get_package(self, name):
+        if hasattr(self.store, 'scan') and name not in self.cache_store:
+            pmap = dict(self.store.scan(f"{name}.").items())
+            if name in self.store:
+                pmap[name] = self.store.get(name)
+            # cache misses too, otherwise every import in the process would scan the store
+            self.cache_store[name] = packages_to_dict(pmap).get(name)
+        return self.cache_store.get(name)
 
     def find_spec(self, fullname, path, target=None):
         parts = fullname.split(".")
-        if len(parts) > 0 and parts[0] in self.cache_store:
-            d = self.cache_store[parts[0]]
+        d = self.__get_package(parts[0]) if len(parts) > 0 else None
+        if d is not None:
             s = list(reversed(parts[1:]))
             k = parts[0]
             while len(s) > 0:
@@ -182,9 +293,44 @@ class DictFinder(_MetaPathFinder):
 
         return None
 
+    # When the store can diff versions only the package trees and modules touched between the last seen
+    # HEAD and the current one are dropped; everything else stays imported.
     def invalidate_caches(self):
-        print(f"DictFinder: invalidating cache")
-        self.__build_key_cache()
+        version = self.store.get_head() if hasattr(self.store, 'diff_keys') else None
+        min_version = self.store.get_min_version() if hasattr(self.store, 'get_min_version') else None
+        if version is None or self.version is None or (min_version is not None and self.version < min_version):
+            print(f"DictFinder: invalidating cache")
+            self.__build_key_cache()
+            return
+        if version == self.version:
+            return
+        added, changed, removed = self.store.diff_keys(self.version, version)
+        self.version = version
+        keys = [*added, *changed, *removed]
+        for root in {k.split(".")[0] for k in keys}:
+            self.cache_store.pop(root, None)
+        evicted = evict_modules(keys)
+        print(f"DictFinder: invalidated {len(keys)} keys, {len(evicted)} modules")
+
+
+# Remove the modules loaded from the given store keys from sys.modules: the module for each key, the
+# packages above it (they hold the key as an attribute) and any modules below it.
+def evict_modules(keys):
+    keys = set(keys)
+    ancestors = set()
+    for key in keys:
+        parts = key.split(".")
+        for i in range(1, len(parts)):
+            ancestors.add(".".join(parts[:i]))
+    evicted = []
+    for name, module in list(sys.modules.items()):
+        if not getattr(module, '__push__', False):
+            continue
+        parts = name.split(".")
+        if name in ancestors or any(".".join(parts[:i]) in keys for i in range(1, len(parts) + 1)):
+            del sys.modules[name]
+            evicted.append(name)
+    return evicted
 
 
 def load_module_pyz_loader(pyz_dict, name=None):
@@ -369,18 +515,74 @@ def load_lambda(kvstore, src):
     return src
 
 
+def store_head(kvstore):
+    return kvstore.get_head() if hasattr(kvstore, 'get_head') else None
+
+
+# Resolved callables keyed by code store key and the HEAD they were resolved at.  A HEAD change makes every
+# entry stale; for stores with head change listeners the entries are also dropped eagerly.  Stores without
+# a HEAD (plain dicts) are not cached as there is no way to tell when a value changes.
+class LambdaCache:
+
+    def __init__(self, kvstore, max_entries=1024):
+        self.kvstore = kvstore
+        self.max_entries = max_entries
+        self.__entries = {}
+        self.hits = 0
+        self.misses = 0
+        if hasattr(kvstore, 'add_head_change_listener'):
+            kvstore.add_head_change_listener(self.on_head_change)
+
+    def head(self):
+        return store_head(self.kvstore)
+
+    def get(self, key):
+        entry = self.__entries.get(key)
+        if entry is not None and entry[0] == self.head():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    # head should be read before the value is resolved, so a concurrent HEAD change leaves the entry stale
+    def put(self, key, fn, head):
+        if head is None:
+            return
+        entries = self.__entries
+        if key not in entries and len(entries) >= self.max_entries:
+            entries.pop(next(iter(entries)), None)
+        entries[key] = (head, fn)
+
+    def on_head_change(self, head):
+        self.__entries = {}
+
+    def stats(self):
+        return {'entries': len(self.__entries), 'hits': self.hits, 'misses': self.misses}
+
+
 class KvStoreLambda:
     key: str
 
     def __init__(self, kvstore, key):
         self.kvstore = kvstore
         self.key = key
+        self.__resolved = None
 
     def __call__(self, *args, **kwargs):
         self.apply(*args, **kwargs)
 
-    def apply(self, *args, **kwargs):
+    # cached until HEAD moves
+    def resolve(self):
+        head = store_head(self.kvstore)
+        resolved = self.__resolved
+        if head is not None and resolved is not None and resolved[0] == head:
+            return resolved[1]
         src = load_src(self.kvstore, self.key)
+        self.__resolved = (head, src) if head is not None and src is not None else None
+        return src
+
+    def apply(self, *args, **kwargs):
+        src = self.resolve()
         if src is not None:
             try:
                 src(*args, **kwargs)
@@ -418,9 +620,12 @@ class CodeStoreLoader:
     #     pass
 
     @staticmethod
-    def install(stores, enable_debug=False):
+    def install(stores, enable_debug=False, bytecode_cache_dir=None):
         import sys
 
+        if bytecode_cache_dir is not None:
+            bytecode_cache.cache_dir = bytecode_cache_dir
+
         class DebugFinder(_MetaPathFinder):
             @classmethod
             def find_spec(cls, name, path, target=None):
@@ -1,4 +1,6 @@
+import hashlib
 import typing
+from bisect import bisect
 
 import GPUtil
 import psutil
@@ -198,15 +200,80 @@ def get_cluster_info(hosts):
     return hosts.lockData()
 
 
-def get_partition_info(hosts, so):
-    all_nodes = [so.selfNode, *so.otherNodes]
+# ids of the live nodes compatible with this one, sorted, along with this node's resources
+def get_partition_nodes(hosts, so):
     all_host_resources = hosts.lockData()
-    if so.selfNode.id not in all_host_resources:
-        return 0, 0, {}
-    host_resources = all_host_resources[so.selfNode.id]
-    all_nodes = [x for x in all_nodes if hosts.isOwned(x.id)]
-    if so.selfNode not in all_nodes:
+    host_resources = all_host_resources.get(so.selfNode.id)
+    if host_resources is None or not hosts.isOwned(so.selfNode.id):
+        return [], {}
+    all_nodes = [x.id for x in [so.selfNode, *so.otherNodes] if hosts.isOwned(x.id)]
+    all_nodes = sorted(x for x in all_nodes if host_resources.is_compatible(all_host_resources[x]))
+    return all_nodes, host_resources
+
+
+# ids of the live nodes, sorted, optionally only those with capacity for requirements.  Unlike
+# get_partition_nodes this does not depend on the calling node, so every node arrives at the same set.
+def get_live_nodes(hosts, so, requirements=None):
+    all_host_resources = hosts.lockData()
+    nodes = [x.id for x in [so.selfNode, *so.otherNodes] if x.id in all_host_resources and hosts.isOwned(x.id)]
+    if requirements is not None:
+        nodes = [x for x in nodes if all_host_resources[x].has_capacity(requirements)]
+    return sorted(nodes)
+
+
+def get_partition_info(hosts, so):
+    all_nodes, host_resources = get_partition_nodes(hosts, so)
+    if len(all_nodes) == 0:
         return 0, 0, {}
-    all_nodes = sorted(all_nodes, key=lambda x: x.id)
-    all_nodes = [x for x in all_nodes if host_resources.is_compatible(all_host_resources[x.id])]
-    return len(all_nodes), all_nodes.index(so.selfNode), host_resources
+    return len(all_nodes), all_nodes.index(so.selfNode.id), host_resources
+
+
+def _ring_hash(key):
+    return int.from_bytes(hashlib.md5(str(key).encode('utf8')).digest()[:8], 'big')
+
+
+# Consistent hash ring over node ids: each node owns vnodes points on the ring and a key belongs to the node of
+#   the next point clockwise, so a node joining or leaving only moves the keys adjacent to its own points
+#   instead of reshuffling everything the way count/index modulo partitioning does.
+class PartitionRing:
+
+    def __init__(self, nodes, vnodes=64):
+        self.nodes = tuple(nodes)
+        self.vnodes = vnodes
+        points = sorted((_ring_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self.__hashes = [x[0] for x in points]
+        self.__owners = [x[1] for x in points]
+        self.__partitions = dict()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def node_for(self, key):
+        if len(self.__owners) == 0:
+            return None
+        return self.__owners[bisect(self.__hashes, _ring_hash(key)) % len(self.__owners)]
+
+    # partitions in range(count) owned by node
+    def partitions(self, node, count):
+        key = (node, count)
+        p = self.__partitions.get(key)
+        if p is None:
+            p = [i for i in range(count) if self.node_for(i) == node]
+            self.__partitions[key] = p
+        return p
+
+
+_partition_rings = dict()
+
+
+# Ring over the live nodes with capacity for requirements (all live nodes if None), the same on every node so
+# each partition has a single owner cluster-wide.  Rings are only rebuilt when the set of nodes changes.
+def get_partition_ring(hosts, so, requirements=None, vnodes=64):
+    key = (tuple(get_live_nodes(hosts, so, requirements)), vnodes)
+    ring = _partition_rings.get(key)
+    if ring is None:
+        if len(_partition_rings) >= 16:
+            _partition_rings.clear()
+        ring = PartitionRing(key[0], vnodes=vnodes)
+        _partition_rings[key] = ring
+    return ring
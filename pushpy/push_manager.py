@@ -1,7 +1,18 @@
-from multiprocessing.managers import BaseManager, listener_client
+import io
+import pickle
+import random
+import struct
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from multiprocessing.connection import Listener, Client
+from multiprocessing.managers import BaseManager, BaseProxy, listener_client, dispatch
 
 import dill
 
+from pushpy.push_server_utils import host_to_address
+
 
 # def create_client_override():
 #     m = listener_client['pickle'][1]
@@ -30,27 +41,57 @@ import dill
 #
 #     return override_client
 
+# values that are never callables or containers, skipped without a call when walking arguments
+_PLAIN_TYPES = frozenset((str, bytes, bytearray, int, float, complex, bool, type(None)))
+
+
+# callables and types in the argument containers (lists, tuples and dicts) are shipped as dill bytes, which the
+# server side loads as code (see load_lambda); the state of other objects is pickled as-is.  Containers holding
+# nothing to convert are returned unchanged rather than copied.
+def convert_callables(a):
+    if isinstance(a, (list, tuple)):
+        if _PLAIN_TYPES.issuperset(map(type, a)):
+            return a
+        converted = None
+        for i, x in enumerate(a):
+            if type(x) in _PLAIN_TYPES:
+                continue
+            y = convert_callables(x)
+            if y is not x:
+                if converted is None:
+                    converted = list(a)
+                converted[i] = y
+        if converted is None:
+            return a
+        return converted if isinstance(a, list) else tuple(converted)
+    elif isinstance(a, dict):
+        if _PLAIN_TYPES.issuperset(map(type, a.values())):
+            return a
+        converted = None
+        for k, v in a.items():
+            if type(v) in _PLAIN_TYPES:
+                continue
+            y = convert_callables(v)
+            if y is not v:
+                if converted is None:
+                    converted = dict(a)
+                converted[k] = y
+        return a if converted is None else converted
+    return dill.dumps(a) if isinstance(a, type) or callable(a) else a
+
+
 def create_client_override():
     m = listener_client['pickle'][1]
 
-    def __convert(a):
-        if isinstance(a, list):
-            return [__convert(x) for x in a]
-        elif isinstance(a, tuple):
-            return tuple(__convert(list(a)))
-        elif isinstance(a, dict):
-            return {k: __convert(v) for k, v in a.items()}
-        return dill.dumps(a) if isinstance(a, type) or callable(a) else a
-
     def override_client(*args, **kwargs):
         x = m(*args, **kwargs)
         x.__send = x.send
 
         def _send(obj):
             # print(f"sending: ", obj)
-            # o = dill.dumps(__convert(obj))
+            # o = dill.dumps(convert_callables(obj))
             # print(o)
-            x.__send(__convert(obj))
+            x.__send(convert_callables(obj))
             # print(f"sent: {o}")
 
         x.send = _send
@@ -91,12 +132,326 @@ def create_listener_override():
 listener_client['dill'] = (listener_client['pickle'][0], create_client_override())
 
 
+def _array_from_buffer(typecode, buffer):
+    a = array(typecode)
+    a.frombytes(buffer)
+    return a
+
+
+# below this an extra frame costs more than copying the data into the pickle
+OUT_OF_BAND_MIN_SIZE = 64 * 1024
+
+
+def _reduce_buffer(obj):
+    if isinstance(obj, memoryview):
+        if obj.contiguous and obj.nbytes >= OUT_OF_BAND_MIN_SIZE:
+            return memoryview, (pickle.PickleBuffer(obj),)
+        return memoryview, (obj.tobytes(),)
+    if isinstance(obj, array) and obj.itemsize * len(obj) >= OUT_OF_BAND_MIN_SIZE:
+        return _array_from_buffer, (obj.typecode, pickle.PickleBuffer(obj))
+    return NotImplemented
+
+
+# Protocol 5 pickler that sends memoryview and array data (and anything else reducing to a PickleBuffer, e.g.
+# numpy arrays) out-of-band instead of copying it into the pickle stream.  bytes and bytearray are written
+# in-band by the C pickler.
+class BufferPickler(pickle.Pickler):
+
+    def __init__(self, file, buffer_callback=None):
+        super().__init__(file, protocol=5, buffer_callback=buffer_callback)
+
+    def reducer_override(self, obj):
+        return _reduce_buffer(obj)
+
+
+# Client side pickler: callables and types in the arguments are converted by convert_callables first.  Doing
+# this while pickling would also convert a class that some other object in the message reduces to, as pickle
+# reuses the first form it saved an object in, e.g. (Fraction, Fraction(1, 3)) could not be loaded.
+class CallablePickler(BufferPickler):
+
+    def dump(self, obj):
+        super().dump(convert_callables(obj))
+
+
+# A message is one frame holding the pickle followed by the out-of-band buffer lengths and their count, then one
+# frame per buffer, which is sent straight from the buffer and received into a preallocated bytearray.
+def send_framed(conn, obj, pickler=BufferPickler):
+    buffers = []
+    f = io.BytesIO()
+    pickler(f, buffer_callback=buffers.append).dump(obj)
+    raw = [b.raw() for b in buffers]
+    f.write(struct.pack(f"!{len(raw)}QI", *(r.nbytes for r in raw), len(raw)))
+    conn.send_bytes(f.getbuffer())
+    for r in raw:
+        conn.send_bytes(r)
+
+
+def recv_framed(conn):
+    msg = conn.recv_bytes()
+    end = len(msg) - 4
+    n, = struct.unpack_from("!I", msg, end)
+    end -= 8 * n
+    buffers = []
+    for length in struct.unpack_from(f"!{n}Q", msg, end):
+        b = bytearray(length)
+        if length > 0:
+            conn.recv_bytes_into(b)
+        else:
+            conn.recv_bytes()
+        buffers.append(b)
+    return pickle.loads(memoryview(msg)[:end], buffers=buffers)
+
+
+def _framed(conn, pickler):
+    conn.send = lambda obj: send_framed(conn, obj, pickler)
+    conn.recv = lambda: recv_framed(conn)
+    return conn
+
+
+class _FramedListener(Listener):
+
+    def accept(self):
+        return _framed(super().accept(), BufferPickler)
+
+
+def _framed_client(*args, **kwargs):
+    return _framed(Client(*args, **kwargs), CallablePickler)
+
+
+listener_client['push'] = (_FramedListener, _framed_client)
+
+
+# errors that mean the manager connection is gone, as opposed to errors raised by the remote call
+CONNECTION_ERRORS = (ConnectionError, EOFError, OSError)
+
+
+# BaseProxy keeps one socket per thread per manager address, shared by every proxy (old or new) for that address,
+# so once the server goes away all proxies keep failing on the dead socket.  This forgets the address's sockets:
+# the calling thread's is closed, and proxies created afterwards open new ones.
+def drop_proxy_connections(address):
+    with BaseProxy._mutex:
+        tls_idset = BaseProxy._address_to_local.pop(address, None)
+    if tls_idset is None:
+        return
+    conn = getattr(tls_idset[0], 'connection', None)
+    if conn is not None:
+        del tls_idset[0].connection
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+
 class PushManager(BaseManager):
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, serializer="dill", **kwargs)
+        kwargs.setdefault('serializer', "push")
+        super().__init__(*args, **kwargs)
 
     def connect(self) -> None:
         super().connect()
         self.register('get_registry')
-        for n in self.get_registry().apply():
+        try:
+            names = self.get_registry().apply()
+        except CONNECTION_ERRORS:
+            # most likely a socket to a previous instance of the server
+            drop_proxy_connections(self._address)
+            names = self.get_registry().apply()
+        for n in names:
             self.register(n)
+
+
+def ping_manager(m):
+    conn = m._Client(m._address, authkey=m._authkey)
+    try:
+        dispatch(conn, None, 'dummy')
+    finally:
+        conn.close()
+
+
+class _HostConnections:
+
+    def __init__(self, max_managers):
+        self.lock = threading.Condition()
+        self.idle = []
+        self.open = 0
+        self.max_managers = max_managers
+        self.shared = None
+        self.checked = dict()
+        self.failures = 0
+        self.next_attempt = 0
+
+
+# Pool of connected PushManagers per host.  Managers are checked for liveness (at most every check_interval
+# seconds) before being handed out, dead ones are replaced, and reconnects to a failing host back off
+# exponentially with jitter so many clients do not retry in lockstep.  At most max_managers_per_host managers
+# are handed out for a host at once; acquire blocks until one is free.  Note this limits concurrent users of the
+# pool, not sockets: a manager holds no socket itself, while proxies share one socket per thread per host.
+#   ex usage:
+#       pool = PushManagerPool(authkey=b'password')
+#       with pool.connection("localhost:50000") as m:
+#           m.local_tasks().apply("my_lambda")
+#       tasks = pool.proxy("localhost:50000", "local_tasks")   # reconnects transparently
+class PushManagerPool:
+
+    def __init__(self, authkey=b'password', max_managers_per_host=4, check_interval=5.0, min_backoff=0.1,
+                 max_backoff=10.0):
+        self.authkey = authkey
+        self.max_managers_per_host = max_managers_per_host
+        self.check_interval = check_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.__hosts = dict()
+        self.__lock = threading.Lock()
+
+    def __host(self, host):
+        with self.__lock:
+            h = self.__hosts.get(host)
+            if h is None:
+                h = _HostConnections(self.max_managers_per_host)
+                self.__hosts[host] = h
+            return h
+
+    def __is_alive(self, h, m):
+        if time.time() - h.checked.get(id(m), 0) < self.check_interval:
+            return True
+        try:
+            ping_manager(m)
+        except CONNECTION_ERRORS:
+            return False
+        h.checked[id(m)] = time.time()
+        return True
+
+    def __open(self, host, h, deadline):
+        delay = h.next_attempt - time.time()
+        if delay > 0:
+            if deadline is not None and time.time() + delay > deadline:
+                raise ConnectionError(f"backing off reconnecting to {host}")
+            time.sleep(delay)
+        m = PushManager(address=host_to_address(host), authkey=self.authkey)
+        try:
+            m.connect()
+        except CONNECTION_ERRORS:
+            drop_proxy_connections(m._address)
+            with h.lock:
+                h.failures += 1
+                backoff = min(self.max_backoff, self.min_backoff * 2 ** (h.failures - 1))
+                h.next_attempt = time.time() + backoff * random.uniform(0.5, 1.0)
+            raise
+        with h.lock:
+            h.failures = 0
+            h.checked[id(m)] = time.time()
+        return m
+
+    def acquire(self, host, timeout=None):
+        h = self.__host(host)
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            with h.lock:
+                while len(h.idle) == 0 and h.open >= h.max_managers:
+                    remaining = deadline - time.time() if deadline is not None else None
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"no connection to {host} available")
+                    h.lock.wait(remaining)
+                m = h.idle.pop() if len(h.idle) > 0 else None
+                h.open += 1 if m is None else 0
+            if m is not None:
+                if self.__is_alive(h, m):
+                    return m
+                self.release(host, m, broken=True)
+                continue
+            try:
+                return self.__open(host, h, deadline)
+            except BaseException:
+                with h.lock:
+                    h.open -= 1
+                    h.lock.notify()
+                raise
+
+    def release(self, host, m, broken=False):
+        h = self.__host(host)
+        if broken:
+            drop_proxy_connections(m._address)
+        with h.lock:
+            if broken:
+                h.open -= 1
+                h.checked.pop(id(m), None)
+                if h.shared is m:
+                    h.shared = None
+            elif h.shared is not m:
+                h.idle.append(m)
+            h.lock.notify()
+
+    @contextmanager
+    def connection(self, host, timeout=None):
+        m = self.acquire(host, timeout=timeout)
+        broken = False
+        try:
+            yield m
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.release(host, m, broken=broken)
+
+    # a single manager for the host shared by all callers, checked and replaced like pooled ones; it counts
+    # towards max_managers_per_host
+    def connect(self, host, timeout=None):
+        h = self.__host(host)
+        m = h.shared
+        if m is not None and self.__is_alive(h, m):
+            return m
+        if m is not None:
+            self.release(host, m, broken=True)
+        m = self.acquire(host, timeout=timeout)
+        with h.lock:
+            if h.shared is None:
+                h.shared = m
+                return m
+        self.release(host, m)
+        return h.shared
+
+    def proxy(self, host, typeid, retries=1):
+        return ReconnectingProxy(self, host, typeid, retries=retries)
+
+    def close(self):
+        with self.__lock:
+            self.__hosts = dict()
+
+
+# Proxy for a registry object that survives dropped connections: a call failing with a connection error
+# reconnects through the pool and is retried up to retries times.  Note a call may have run on the server
+# before the connection dropped, so retried methods should be idempotent.
+class ReconnectingProxy:
+
+    def __init__(self, pool, host, typeid, retries=1):
+        self._pool = pool
+        self._host = host
+        self._typeid = typeid
+        self._retries = retries
+        # (manager, proxy) of the manager last used
+        self._proxy = None
+
+    def __get_proxy(self, m):
+        entry = self._proxy
+        if entry is None or entry[0] is not m:
+            entry = (m, getattr(m, self._typeid)())
+            self._proxy = entry
+        return entry[1]
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def _call(*args, **kwargs):
+            for attempt in range(self._retries + 1):
+                m = None
+                try:
+                    m = self._pool.connect(self._host)
+                    return getattr(self.__get_proxy(m), method)(*args, **kwargs)
+                except CONNECTION_ERRORS:
+                    if m is not None:
+                        self._pool.release(self._host, m, broken=True)
+                    if attempt == self._retries:
+                        raise
+
+        return _call
@@ -0,0 +1,308 @@
+import asyncio
+import itertools
+import pickle
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Connection, answer_challenge, deliver_challenge
+
+import dill
+
+from pushpy.push_manager import PushManager, convert_callables
+from pushpy.push_server_utils import host_to_address
+
+# Multiplexed transport for PushManager registry objects.
+#
+# BaseManager proxies make one synchronous request per method call, and the server opens a new connection for
+# every object access.  Here a client keeps a single persistent connection per node and tags each request with
+# an id, so any number of calls can be in flight at once and complete out of order:
+#
+#   request:  (request_id, typeid, method, args, kwargs)
+#   response: (request_id, ok, value)           value is the result, or the exception if not ok
+#
+# Frames and authentication are those of multiprocessing.connection, using the manager's auth key.  Messages are
+# plain pickles, falling back to dill for values pickle cannot handle; as with PushManager, callables in the
+# arguments are sent as dill bytes.
+#
+#   ex usage:
+#       client = MuxClient(mux_address("localhost:50000"), authkey=b'password')
+#       store = client.proxy("repl_code_store")
+#       head = store.get_head()
+#       futures = [store.get.submit(k) for k in keys]
+#       value = await store.get.aio("/web/hello")
+
+MUX_PORT_OFFSET = 1000
+
+
+def mux_address(manager_host, mux_port=None):
+    host, port = host_to_address(manager_host)
+    return host, mux_port or port + MUX_PORT_OFFSET
+
+
+def _dumps(obj):
+    try:
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return dill.dumps(obj)
+
+
+def _error_response(request_id, e):
+    try:
+        return _dumps((request_id, False, e))
+    except Exception:
+        return _dumps((request_id, False, RuntimeError(repr(e))))
+
+
+class _MuxConnection:
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.lock = threading.Lock()
+        # bumped whenever reading is handed to a new thread; a reader whose generation is stale stops reading
+        self.generation = 0
+        # set while the current reader is handling a call instead of reading
+        self.busy_since = None
+        self.closed = False
+
+
+class MuxServer:
+
+    def __init__(self, address, authkey, registry=None, handoff_delay=0.005):
+        self.address = address
+        self.authkey = authkey
+        # typeid -> (callable, ...) as in BaseManager._registry
+        self.registry = registry if registry is not None else PushManager._registry
+        self.handoff_delay = handoff_delay
+        self.__objects = dict()
+        self.__connections = set()
+        self.__socket = None
+        self.__running = False
+
+    def start(self):
+        self.__socket = socket.create_server(self.address)
+        self.__running = True
+        threading.Thread(target=self.__handoff_loop, daemon=True, name="push-mux-handoff").start()
+        thread = threading.Thread(target=self.__accept_loop, daemon=True, name="push-mux-accept")
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.__running = False
+        if self.__socket is not None:
+            self.__socket.close()
+
+    def __accept_loop(self):
+        while self.__running:
+            try:
+                sock, _ = self.__socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.__serve, args=(sock,), daemon=True).start()
+
+    def __serve(self, sock):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(sock.detach())
+        try:
+            deliver_challenge(conn, self.authkey)
+            answer_challenge(conn, self.authkey)
+        except Exception as e:
+            print(f"mux authentication failed: {e}")
+            conn.close()
+            return
+        c = _MuxConnection(conn)
+        self.__connections.add(c)
+        self.__read_loop(c, 0)
+
+    # Calls are handled inline by the thread reading the connection, as handing every request to a pool costs
+    # more than most calls.  When a call runs longer than handoff_delay, reading moves to a new thread so the
+    # requests queued behind it keep flowing, and the slow call's thread retires once it is done.
+    def __read_loop(self, c, generation):
+        while True:
+            with c.lock:
+                if c.generation != generation:
+                    return
+                c.busy_since = None
+            try:
+                if not self.__running:
+                    raise EOFError
+                request = c.conn.recv_bytes()
+            except (EOFError, OSError):
+                c.closed = True
+                self.__connections.discard(c)
+                c.conn.close()
+                return
+            c.busy_since = time.monotonic()
+            self.__handle(c.conn, c.send_lock, request)
+
+    def __handoff_loop(self):
+        while self.__running:
+            time.sleep(self.handoff_delay)
+            now = time.monotonic()
+            for c in list(self.__connections):
+                with c.lock:
+                    if c.closed or c.busy_since is None or now - c.busy_since < self.handoff_delay:
+                        continue
+                    c.generation += 1
+                    c.busy_since = None
+                    threading.Thread(target=self.__read_loop, args=(c, c.generation), daemon=True).start()
+
+    def __get_object(self, typeid):
+        obj = self.__objects.get(typeid)
+        if obj is None:
+            entry = self.registry.get(typeid)
+            if entry is None or entry[0] is None:
+                raise KeyError(f"unknown typeid: {typeid}")
+            obj = entry[0]()
+            self.__objects[typeid] = obj
+        return obj
+
+    def __call(self, typeid, method, args, kwargs):
+        if typeid is None:
+            # the registry itself, so clients do not need a separate round trip to discover it
+            return [k for k, v in self.registry.items() if v[0] is not None]
+        obj = self.__get_object(typeid)
+        if method is None:
+            return obj
+        if method.startswith('_'):
+            raise AttributeError(f"method is not exposed: {method}")
+        return getattr(obj, method)(*args, **kwargs)
+
+    def __handle(self, conn, send_lock, request):
+        request_id = None
+        try:
+            request_id, typeid, method, args, kwargs = pickle.loads(request)
+            response = _dumps((request_id, True, self.__call(typeid, method, args, kwargs)))
+        except Exception as e:
+            response = _error_response(request_id, e)
+        try:
+            with send_lock:
+                conn.send_bytes(response)
+        except (EOFError, OSError):
+            pass
+
+
+class _MuxMethod:
+
+    def __init__(self, client, typeid, method):
+        self.client = client
+        self.typeid = typeid
+        self.method = method
+
+    def __call__(self, *args, **kwargs):
+        return self.client.call(self.typeid, self.method, *args, **kwargs)
+
+    def submit(self, *args, **kwargs) -> Future:
+        return self.client.submit(self.typeid, self.method, *args, **kwargs)
+
+    def aio(self, *args, **kwargs):
+        return self.client.aio(self.typeid, self.method, *args, **kwargs)
+
+
+class MuxProxy:
+
+    def __init__(self, client, typeid):
+        self._client = client
+        self._typeid = typeid
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return _MuxMethod(self._client, self._typeid, method)
+
+
+class MuxClient:
+
+    def __init__(self, address, authkey=b'password', timeout=None):
+        self.address = address
+        self.timeout = timeout
+        sock = socket.create_connection(address, timeout=timeout)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.__conn = Connection(sock.detach())
+        answer_challenge(self.__conn, authkey)
+        deliver_challenge(self.__conn, authkey)
+        self.__ids = itertools.count()
+        self.__pending = dict()
+        # guards registering a call against the reader failing all pending calls when the connection is lost
+        self.__pending_lock = threading.Lock()
+        self.__send_lock = threading.Lock()
+        self.__closed = False
+        self.__reader = threading.Thread(target=self.__read_loop, daemon=True, name="push-mux-client")
+        self.__reader.start()
+
+    def __read_loop(self):
+        error = None
+        try:
+            while True:
+                request_id, ok, value = pickle.loads(self.__conn.recv_bytes())
+                future = self.__pending.pop(request_id, None)
+                if future is None:
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+        except Exception as e:
+            error = e
+        with self.__pending_lock:
+            self.__closed = True
+            pending, self.__pending = self.__pending, dict()
+        for future in pending.values():
+            future.set_exception(ConnectionError(f"mux connection lost: {error}"))
+
+    @property
+    def closed(self):
+        return self.__closed
+
+    def close(self):
+        self.__closed = True
+        # wake the reader blocked on the socket, which then fails the pending calls
+        try:
+            sock = socket.fromfd(self.__conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+        except OSError:
+            pass
+        self.__conn.close()
+
+    def submit(self, typeid, method, *args, **kwargs) -> Future:
+        if self.__closed:
+            raise ConnectionError("mux connection is closed")
+        request_id = next(self.__ids)
+        future = Future()
+        with self.__pending_lock:
+            self.__pending[request_id] = future
+            closed = self.__closed
+        if closed:
+            # lost the race with the reader's final sweep, which may not have seen this call
+            if self.__pending.pop(request_id, None) is not None:
+                future.set_exception(ConnectionError("mux connection is closed"))
+            return future
+        request = _dumps((request_id, typeid, method, convert_callables(args), convert_callables(kwargs)))
+        try:
+            with self.__send_lock:
+                self.__conn.send_bytes(request)
+        except Exception:
+            self.__pending.pop(request_id, None)
+            raise
+        return future
+
+    def call(self, typeid, method, *args, **kwargs):
+        return self.submit(typeid, method, *args, **kwargs).result(self.timeout)
+
+    def aio(self, typeid, method, *args, **kwargs):
+        return asyncio.wrap_future(self.submit(typeid, method, *args, **kwargs))
+
+    def registry(self):
+        return self.call(None, None)
+
+    def proxy(self, typeid):
+        return MuxProxy(self, typeid)
+
+    def __getattr__(self, typeid):
+        # mirrors PushManager, e.g. client.repl_code_store()
+        if typeid.startswith('_'):
+            raise AttributeError(typeid)
+        return lambda: self.proxy(typeid)
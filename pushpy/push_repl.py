@@ -6,19 +6,14 @@ import uuid
 
 import dill
 
-from pushpy.push_manager import PushManager
-from pushpy.push_server_utils import host_to_address
+from pushpy.push_manager import PushManagerPool
 
-push_managers = dict()
+push_managers = PushManagerPool(authkey=b'password')
 default_host = sys.argv[1]
 
 
 def connect_to_host(host):
-    if host not in push_managers:
-        m = PushManager(address=host_to_address(host), authkey=b'password')
-        m.connect()
-        push_managers[host] = m
-    return push_managers[host]
+    return push_managers.connect(host)
 
 
 def host_exec_cmd(dt, cmd):
@@ -30,12 +25,15 @@ def hello_cmd(cmd):
     cmd = cmd[1:]
     if cmd == "host" or cmd == "host_resources":
         cmd = "host_resources"
+    elif cmd == "stats" or cmd.startswith("stats "):
+        name = cmd[len("stats"):].strip()
+        cmd = f"lambda_stats.stats({name!r})" if name else "lambda_stats.stats()"
     return cmd
 
 
 async def hello(host):
-    m = connect_to_host(host)
-    dt = m.local_tasks()
+    # survives the node restarting or the connection dropping between commands
+    dt = push_managers.proxy(host, "local_tasks")
     print(f"{host} >>> ", end='')
     sys.stdout.flush()
     for line in sys.stdin:
@@ -55,8 +53,7 @@ async def sac_cmd(cmd):
         host = cmd[1:]
         await hello(host)
     elif cmd == "hosts":
-        m = connect_to_host(default_host)
-        dt = m.local_tasks()
+        dt = push_managers.proxy(default_host, "local_tasks")
         r = host_exec_cmd(dt, "[v.mgr.host for k, v in get_cluster_info().items()]")
         print(r)
     else:
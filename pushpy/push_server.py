@@ -11,11 +11,16 @@ def main(config_fname=None):
     from pysyncobj import SyncObj, SyncObjConsumer
     from pysyncobj import SyncObjConf
 
-    from pushpy.batteries import ReplLockDataManager
-    from pushpy.code_store import load_in_memory_module, create_in_memory_module
-    from pushpy.host_resources import HostResources, GPUResources, get_cluster_info, get_partition_info
+    from pushpy.batteries import ReplLockDataManager, ReplTaskScheduler, ReplPartitionedQueue, ReplResultStore, \
+        ReplTaskManager, ReplCronScheduler
+    from pushpy.blob_store import LocalBlobStore
+    from pushpy.code_store import load_in_memory_module, create_in_memory_module, bytecode_cache
+    from pushpy.host_resources import HostResources, GPUResources, get_cluster_info, get_partition_info, \
+        get_partition_ring
     from pushpy.push_manager import PushManager
+    from pushpy.push_mux import MuxServer, MUX_PORT_OFFSET
     from pushpy.push_server_utils import load_config, serve_forever, host_to_address
+    from pushpy.task_manager import TaskManager
 
     if config_fname is None:
         import sys
@@ -26,6 +31,7 @@ def main(config_fname=None):
     config_manager = config['manager']
     manager_auth_key = (config_manager.get('auth_key') or 'password').encode('utf8')
     base_host = config.get('hostname') or socket.gethostname()
+    bytecode_cache.cache_dir = (config.get('code_store') or {}).get('bytecode_cache_dir')
 
     if 'manager_host' in config_bootstrap:
         bootstrap_manager_host = config_bootstrap['manager_host']
@@ -49,6 +55,7 @@ def main(config_fname=None):
         sync_obj_password = config_sync_obj['password'].encode('utf-8') if 'password' in config_sync_obj else None
 
     manager_port = int(config_manager.get('port') or (sync_obj_port % 1000) + 50000)
+    mux_port = int(config_manager.get('mux_port') or manager_port + MUX_PORT_OFFSET)
     web_port = int((config.get('web') or {}).get('port') or (sync_obj_port % 1000) + 11000)
     sync_obj_host = f"{base_host}:{sync_obj_port}"
     manager_host = f"{base_host}:{manager_port}"
@@ -63,6 +70,27 @@ def main(config_fname=None):
     boot_globals, web_router = boot_mod.main()
     boot_consumers = [x for x in boot_globals.values() if isinstance(x, SyncObjConsumer) or hasattr(x, '_consumer')]
 
+    if 'repl_results' not in boot_globals:
+        boot_globals['repl_results'] = ReplResultStore()
+        boot_consumers.append(boot_globals['repl_results'])
+    repl_results = boot_globals['repl_results']
+    for x in boot_globals.values():
+        if isinstance(x, ReplTaskManager) and x.results is None:
+            x.results = repl_results
+
+    # tasks submitted to the scheduler run once, on a host chosen by the leader, via the boot task manager
+    boot_task_manager = next((x for x in boot_globals.values() if isinstance(x, TaskManager)), None)
+    if 'repl_scheduler' not in boot_globals and boot_task_manager is not None:
+        boot_globals['repl_scheduler'] = ReplTaskScheduler(repl_hosts, boot_task_manager, results=repl_results)
+        boot_consumers.append(boot_globals['repl_scheduler'])
+    # per lambda call stats of the boot task manager, see LambdaProfiler
+    if boot_task_manager is not None:
+        boot_task_manager.profiler.enabled = bool((config.get('profiling') or {}).get('enabled'))
+        boot_globals['lambda_stats'] = boot_task_manager.profiler
+    if 'repl_cron' not in boot_globals and boot_globals.get('repl_scheduler') is not None:
+        boot_globals['repl_cron'] = ReplCronScheduler(boot_globals['repl_scheduler'])
+        boot_consumers.append(boot_globals['repl_cron'])
+
     drop_connections_list = []
 
     def on_state_change(oldState, newState):
@@ -138,6 +166,7 @@ def main(config_fname=None):
 
     l_get_cluster_info = lambda: get_cluster_info(repl_hosts)
     l_get_partition_info = lambda: get_partition_info(repl_hosts, sync_obj)
+    l_get_partition_ring = lambda requirements=None: get_partition_ring(repl_hosts, sync_obj, requirements)
 
     host_resources = HostResources.create(host_id=sync_obj.selfNode.id, mgr_host=manager_host)
     # override GPU presence if desired
@@ -148,14 +177,25 @@ def main(config_fname=None):
     boot_globals['host_id'] = host_resources.host_id
     boot_globals['get_cluster_info'] = l_get_cluster_info
     boot_globals['get_partition_info'] = l_get_partition_info
+    boot_globals['get_partition_ring'] = l_get_partition_ring
     boot_globals['host_resources'] = host_resources
+    # bulk data uploaded to this node (see blob_store), registered below with the other local_ objects
+    if 'local_blobs' not in boot_globals:
+        boot_globals['local_blobs'] = LocalBlobStore(root=(config.get('blob_store') or {}).get('dir'))
 
     PushManager.register('sync_obj', callable=lambda: sync_obj)
     PushManager.register('bootstrap_peer', callable=lambda: DoBootstrapPeer())
     PushManager.register('get_registry', callable=lambda: DoRegistry())
     PushManager.register("get_cluster_info", callable=lambda: l_get_cluster_info)
     PushManager.register("get_partition_info", callable=lambda: l_get_partition_info)
+    PushManager.register("get_partition_ring", callable=lambda: l_get_partition_ring)
+
+    for x in boot_globals.values():
+        if isinstance(x, ReplPartitionedQueue) and x.get_ring is None:
+            x.get_ring = l_get_partition_ring
     PushManager.register("host_resources", callable=lambda: host_resources)
+    if 'lambda_stats' in boot_globals:
+        PushManager.register("lambda_stats", callable=lambda: boot_globals['lambda_stats'])
 
     boot_common = create_in_memory_module(name="boot_common")
 
@@ -176,6 +216,11 @@ def main(config_fname=None):
     mgmt_server = m.get_server()
     mt = serve_forever(mgmt_server)
 
+    # pipelined clients (see push_mux) reach the same registry objects over one connection per node
+    mux_server = MuxServer(host_to_address(f"{base_host}:{mux_port}"), manager_auth_key)
+    mux_server.start()
+    print(f"mux_host: {base_host}:{mux_port}")
+
     if web_router is None:
         mt.join()
     else:
@@ -186,6 +231,11 @@ def main(config_fname=None):
         # use asyncio to drive tornado so that async io can be used in web handlers
         loop = asyncio.get_event_loop()
 
+        # async lambdas and daemons share the web server's loop
+        for x in boot_globals.values():
+            if isinstance(x, TaskManager):
+                x.set_event_loop(loop)
+
         try:
             loop.run_forever()
         finally:
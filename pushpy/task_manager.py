@@ -1,67 +1,593 @@
+import asyncio
+import cProfile
+import inspect
+import itertools
+import io
+import os
+import pstats
 import threading
+import time
 import uuid
-from queue import Queue, Empty
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, wait as wait_futures
+from queue import Queue, Empty, Full
 
-from pushpy.code_store import load_lambda, KvStoreLambda
+import dill
 
+from pushpy.code_store import load_lambda, KvStoreLambda, LambdaCache
 
+
+# Lifecycle of a daemon as seen through its TaskControl
+TASK_STARTING = "starting"
+TASK_RUNNING = "running"
+TASK_DRAINING = "draining"
+TASK_STOPPED = "stopped"
+TASK_FAILED = "failed"
+TASK_ABANDONED = "abandoned"
+
+
+# Handed to every daemon.  Daemons can keep polling `control.running`, but should prefer blocking on
+# control.wait(timeout) (or `await control.wait_async(timeout)`) which returns as soon as they are
+# cancelled, and should finish their in-flight work before control.deadline.  A daemon that needs time to
+# warm up calls control.ready() once it is serving, which is what hot-swap redeploys wait for.
 class TaskControl:
-    running = True
+
+    def __init__(self):
+        self.state = TASK_STARTING
+        self.error = None
+        self.deadline = None
+        self.heartbeat = time.time()
+        self.__cancelled = threading.Event()
+        self.__ready = threading.Event()
+        self.__lock = threading.Lock()
+        self.__async_waiters = []
+
+    @property
+    def running(self):
+        return not self.__cancelled.is_set()
+
+    @running.setter
+    def running(self, value):
+        if not value:
+            self.cancel()
+
+    def cancel(self, deadline=None):
+        self.deadline = deadline
+        if self.state in (TASK_STARTING, TASK_RUNNING):
+            self.state = TASK_DRAINING
+        with self.__lock:
+            self.__cancelled.set()
+            waiters, self.__async_waiters = self.__async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(True))
+
+    def cancelled(self):
+        return self.__cancelled.is_set()
+
+    # True if cancelled, False if the timeout expired first
+    def wait(self, timeout=None):
+        return self.__cancelled.wait(timeout)
+
+    async def wait_async(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.__lock:
+            if self.__cancelled.is_set():
+                return True
+            self.__async_waiters.append((loop, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    # seconds left to drain once cancelled, None if there is no deadline
+    def remaining(self):
+        return max(self.deadline - time.time(), 0) if self.deadline is not None else None
+
+    def ready(self):
+        if self.state == TASK_STARTING:
+            self.state = TASK_RUNNING
+        self.__ready.set()
+
+    def wait_ready(self, timeout=None):
+        return self.__ready.wait(timeout)
+
+    def beat(self):
+        self.heartbeat = time.time()
+
+    def health(self):
+        return {
+            'state': self.state,
+            'ready': self.__ready.is_set(),
+            'cancelled': self.cancelled(),
+            'heartbeat_age': time.time() - self.heartbeat,
+            'error': repr(self.error) if self.error is not None else None,
+        }
 
 
 class TaskContext:
-    def __init__(self, control, thread):
+    def __init__(self, control, thread, future=None):
         self.control = control
         self.thread = thread
+        # set for async daemons, which run on the task manager's event loop instead of a thread
+        self.future = future
+
+    def is_alive(self):
+        if self.future is None:
+            return self.thread.is_alive()
+        # an abandoned async daemon keeps running after its future is cancelled until it gives up; it marks
+        # itself stopped (or failed) once it does
+        return not self.future.done() or (self.future.cancelled() and self.control.state == TASK_ABANDONED)
+
+
+def _run_daemon(control, src, args, auto_ready=True):
+    if auto_ready:
+        control.ready()
+    try:
+        src(control, *args)
+        control.state = TASK_STOPPED
+    except Exception as e:
+        control.error = e
+        control.state = TASK_FAILED
+        print(e)
+
+
+async def _run_async_daemon(control, src, args, auto_ready=True):
+    if auto_ready:
+        control.ready()
+    try:
+        await src(control, *args)
+        control.state = TASK_STOPPED
+    except asyncio.CancelledError:
+        control.state = TASK_STOPPED
+        raise
+    except Exception as e:
+        control.error = e
+        control.state = TASK_FAILED
+        print(e)
+
+
+def _apply_serialized(src, args):
+    return dill.loads(src)(*args)
+
+
+def _chunks(iterable, chunk_size):
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+# Client side streaming over a PushManager local_tasks / repl_tasks proxy: one round trip per chunk
+# instead of one per item.
+def map_chunked(tasks, src, iterable, chunk_size=1000, workers=1):
+    for chunk in _chunks(iterable, chunk_size):
+        yield from tasks.apply_many(src, chunk, chunk_size=chunk_size, workers=workers)
+
+
+class _EventHandler:
+
+    def __init__(self, name, handler, concurrency, max_queue_size, executor):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.executor = executor
+        self.queue = Queue(maxsize=max_queue_size)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.count = 0
+        self.errors = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'active': self.active,
+            'count': self.count,
+            'errors': self.errors,
+            'rejected': self.rejected,
+            'avg_latency': self.total_latency / self.count if self.count > 0 else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+
+class _LambdaStats:
+    __slots__ = ['calls', 'errors', 'total_latency', 'max_latency', 'histogram', 'profile']
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.profile = None
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'mean_latency': self.total_latency / self.calls if self.calls > 0 else 0.0,
+            'max_latency': self.max_latency,
+            'histogram': {b: c for b, c in zip(LATENCY_BUCKETS, self.histogram) if c > 0},
+            'profiled': self.profile is not None
+        }
+
+
+# Opt-in instrumentation of lambda calls, keyed by code store key and the version (HEAD) they ran at so a
+# regression can be pinned on a deployment.  Keys selected with profile() also run under cProfile, every
+# profile_every calls, with the results accumulated per key and version.  Coroutine lambdas are timed until
+# they complete.
+class LambdaProfiler:
+
+    def __init__(self, version=None, enabled=False, profile_every=1):
+        self.version = version
+        self.enabled = enabled
+        self.profile_every = profile_every
+        self.__profiled = set()
+        self.__stats = dict()
+        self.__lock = threading.Lock()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def profile(self, name, enabled=True):
+        if enabled:
+            self.__profiled.add(name)
+            self.enabled = True
+        else:
+            self.__profiled.discard(name)
+
+    def reset(self):
+        with self.__lock:
+            self.__stats = dict()
+
+    def __get(self, key):
+        s = self.__stats.get(key)
+        if s is None:
+            with self.__lock:
+                s = self.__stats.setdefault(key, _LambdaStats())
+        return s
+
+    def record(self, key, latency, error=False):
+        s = self.__get(key)
+        i = 0
+        while latency > LATENCY_BUCKETS[i]:
+            i += 1
+        with self.__lock:
+            s.calls += 1
+            s.errors += 1 if error else 0
+            s.total_latency += latency
+            s.max_latency = max(s.max_latency, latency)
+            s.histogram[i] += 1
+
+    def __start_profile(self, key):
+        if key[0] not in self.__profiled or self.__get(key).calls % self.profile_every != 0:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler is already active on this thread
+            return None
+        return profiler
+
+    def __end_profile(self, key, profiler):
+        profiler.disable()
+        s = self.__get(key)
+        with self.__lock:
+            if s.profile is None:
+                s.profile = pstats.Stats(profiler)
+            else:
+                s.profile.add(profiler)
+
+    def call(self, name, fn, args, kwargs=None):
+        key = (name, self.version() if self.version is not None else None)
+        profiler = self.__start_profile(key)
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **(kwargs or {}))
+        except Exception:
+            self.record(key, time.perf_counter() - start, error=True)
+            raise
+        finally:
+            if profiler is not None:
+                self.__end_profile(key, profiler)
+        if inspect.isawaitable(result):
+            return self.__timed(key, start, result)
+        self.record(key, time.perf_counter() - start)
+        return result
+
+    async def __timed(self, key, start, aw):
+        try:
+            result = await aw
+        except Exception:
+            self.record(key, time.perf_counter() - start, error=True)
+            raise
+        self.record(key, time.perf_counter() - start)
+        return result
+
+    # {"name@version": stats} optionally limited to one code store key
+    def stats(self, name=None):
+        return {f"{k[0]}@{k[1]}": v.to_dict() for k, v in list(self.__stats.items()) if name is None or k[0] == name}
+
+    # cProfile report for a profiled key, merged across versions unless one is given
+    def profile_stats(self, name, version=None, sort='cumulative', limit=20):
+        profiles = [v.profile for k, v in list(self.__stats.items())
+                    if k[0] == name and v.profile is not None and (version is None or k[1] == version)]
+        if len(profiles) == 0:
+            return None
+        out = io.StringIO()
+        with self.__lock:
+            ps = pstats.Stats(stream=out)
+            for p in profiles:
+                ps.add(p)
+        ps.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+
+# Dispatches events to their handlers on a bounded thread pool (or a process pool for CPU bound handlers).
+# Each handler has its own bounded queue, so a slow handler only backs up its own events: once its queue
+# is full, further events are dropped (and counted as rejected) instead of growing memory without bound.
+# Producers are often replicated callbacks running on the raft apply thread, so they never block unless asked to.
+class EventDispatcher:
+
+    # max number of events a worker handles before yielding the thread to other handlers
+    drain_batch_size = 64
+
+    def __init__(self, max_workers=None, process_workers=0, complete=None, profiler=None):
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.process_workers = process_workers
+        # called with each handler result, e.g. to run coroutines returned by async handlers
+        self.complete = complete
+        self.profiler = profiler
+        self.__handlers = {}
+        self.__executor = None
+        self.__process_executor = None
+        self.__started = False
+
+    def register(self, name, handler, concurrency=1, max_queue_size=1000, executor="thread"):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"unknown executor: {executor}")
+        self.__handlers[name] = _EventHandler(name, handler, concurrency, max_queue_size, executor)
+
+    def start(self):
+        if self.__started:
+            return
+        self.__executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="push-event")
+        if self.process_workers > 0 or any(h.executor == "process" for h in self.__handlers.values()):
+            self.__process_executor = ProcessPoolExecutor(max_workers=self.process_workers or None)
+        self.__started = True
+        for h in self.__handlers.values():
+            self.__schedule(h)
+
+    def shutdown(self, wait=True):
+        self.__started = False
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=wait)
+        if self.__process_executor is not None:
+            self.__process_executor.shutdown(wait=wait)
+
+    # False if the event was rejected because the handler's queue is full
+    def put(self, name, args, block=False, timeout=None):
+        h = self.__handlers[name]
+        try:
+            h.queue.put(args, block=block, timeout=timeout)
+        except Full:
+            h.rejected += 1
+            return False
+        self.__schedule(h)
+        return True
+
+    def clear(self):
+        for h in self.__handlers.values():
+            while not h.queue.empty():
+                try:
+                    h.queue.get_nowait()
+                except Empty:
+                    pass
+
+    def stats(self):
+        return {name: h.stats() for name, h in self.__handlers.items()}
+
+    def __schedule(self, h):
+        if not self.__started:
+            return
+        with h.lock:
+            if h.active >= h.concurrency or h.queue.empty():
+                return
+            h.active += 1
+        self.__executor.submit(self.__drain, h)
+
+    def __drain(self, h):
+        try:
+            for _ in range(self.drain_batch_size):
+                try:
+                    args = h.queue.get_nowait()
+                except Empty:
+                    break
+                self.__handle(h, args)
+        finally:
+            with h.lock:
+                h.active -= 1
+            # events may have arrived after the last get, or the batch limit was hit
+            self.__schedule(h)
+
+    def __handle(self, h, args):
+        start = time.perf_counter()
+        try:
+            fn = h.handler.resolve() if hasattr(h.handler, 'resolve') else h.handler
+            if fn is not None:
+                if h.executor == "process":
+                    self.__process_executor.submit(_apply_serialized, dill.dumps(fn), args).result()
+                else:
+                    if self.profiler is not None and self.profiler.enabled:
+                        r = self.profiler.call(getattr(h.handler, 'key', h.name), fn, args)
+                    else:
+                        r = fn(*args)
+                    if self.complete is not None:
+                        self.complete(r)
+        except Exception as e:
+            with h.lock:
+                h.errors += 1
+            print(e)
+        finally:
+            latency = time.perf_counter() - start
+            with h.lock:
+                h.count += 1
+                h.total_latency += latency
+                h.max_latency = max(h.max_latency, latency)
 
 
 class TaskManager:
 
-    def __init__(self, code_store):
+    def __init__(self, code_store, max_workers=None, process_workers=0):
         self.code_store = code_store
         self.task_threads = dict()
-        self.queue = Queue()
+        self.abandoned = dict()
         self.event_handler_map = {}
+        self.lambda_cache = LambdaCache(code_store)
+        self.profiler = LambdaProfiler(version=self.lambda_cache.head)
+        self.__batch_executor = None
+        self.dispatcher = EventDispatcher(max_workers=max_workers, process_workers=process_workers,
+                                          complete=self.complete, profiler=self.profiler)
+        self.loop = None
+        self.__loop_lock = threading.Lock()
 
-    def clear_events(self):
-        while not self.queue.empty():
-            try:
-                self.queue.get_nowait()
-            except Empty:
-                pass
+    # Coroutine lambdas and async daemons run on this loop: the server's loop if one was set with
+    # set_event_loop, otherwise a dedicated loop thread started on first use.
+    def set_event_loop(self, loop):
+        self.loop = loop
 
-    def on_event_daemon(self, control, handle_map):
-        while control.running:
-            try:
-                s, *a = self.queue.get(timeout=0.1)
-                if s in handle_map:
-                    handle_map[s].apply(*a)
-            except Empty:
-                pass
+    def get_event_loop(self):
+        if self.loop is None:
+            with self.__loop_lock:
+                if self.loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, daemon=True, name="push-tasks-loop").start()
+                    self.loop = loop
+        return self.loop
+
+    def submit_awaitable(self, aw) -> Future:
+        async def _await():
+            return await aw
+
+        return asyncio.run_coroutine_threadsafe(_await(), self.get_event_loop())
+
+    # Waits for awaitable results; on the event loop thread itself the result is scheduled as a task on the
+    # loop and the task is returned for the caller to await, since blocking would deadlock the loop.
+    def complete(self, result):
+        if not inspect.isawaitable(result):
+            return result
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not None and loop is self.loop:
+            return asyncio.ensure_future(result)
+        return self.submit_awaitable(result).result()
 
-    def on_event_handler(self, lambda_name, name=None):
+    def clear_events(self):
+        self.dispatcher.clear()
+
+    # concurrency: max events of this handler processed at once
+    # max_queue_size: pending events before on_event drops events (see event_stats for the rejected count)
+    # executor: "thread" or "process" for CPU bound handlers
+    # block: wait (up to timeout seconds) for room in the queue instead; not for callbacks on the raft apply thread
+    def on_event_handler(self, lambda_name, name=None, concurrency=1, max_queue_size=1000, executor="thread",
+                         block=False, timeout=None):
         name = name or str(uuid.uuid4())
         self.event_handler_map[name] = KvStoreLambda(self.code_store, lambda_name)
+        self.dispatcher.register(name, self.event_handler_map[name], concurrency=concurrency,
+                                 max_queue_size=max_queue_size, executor=executor)
 
         def on_event(*args):
-            self.queue.put((name, *args))
+            return self.dispatcher.put(name, args, block=block, timeout=timeout)
 
         return on_event
 
     def start_event_handlers(self):
-        self.start_daemon(self.on_event_daemon, self.event_handler_map)
+        self.dispatcher.start()
+
+    def event_stats(self):
+        return self.dispatcher.stats()
+
+    # lambdas referenced by code store key are resolved (and get boot_common) once per HEAD
+    def resolve_lambda(self, src):
+        key = src if isinstance(src, str) else None
+        fn = self.lambda_cache.get(key) if key is not None else None
+        if fn is None:
+            head = self.lambda_cache.head()
+            fn = load_lambda(self.code_store, src)
+            if fn is None:
+                raise RuntimeError("lambda is not code")
+            if hasattr(fn, '__globals__'):
+                exec("from boot_common import *", fn.__globals__)
+            if key is not None:
+                self.lambda_cache.put(key, fn, head)
+        return fn
+
+    def __call(self, src, fn, args, kwargs=None):
+        if not self.profiler.enabled:
+            return fn(*args, **(kwargs or {}))
+        return self.profiler.call(src if isinstance(src, str) else "<code>", fn, args, kwargs)
 
     def apply(self, src, *args, **kwargs):
-        src = load_lambda(self.code_store, src)
-        if src is None:
-            raise RuntimeError("lambda is not code")
         try:
-            exec("from boot_common import *", src.__globals__)
-            return eval("src(*args, **kwargs)", {'src': src, 'args': args, 'kwargs': kwargs})
+            return self.complete(self.__call(src, self.resolve_lambda(src), args, kwargs))
         except Exception as e:
             print(e)
             return e
 
+    # for local callers: the future of the result, which for coroutine lambdas completes on the event loop
+    def apply_async(self, src, *args, **kwargs) -> Future:
+        result = self.__call(src, self.resolve_lambda(src), args, kwargs)
+        if inspect.isawaitable(result):
+            return self.submit_awaitable(result)
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def __apply_chunk(self, src, fn, chunk):
+        results = []
+        for args in chunk:
+            try:
+                results.append(self.complete(self.__call(src, fn, args if isinstance(args, tuple) else (args,))))
+            except Exception as e:
+                print(e)
+                results.append(e)
+        return results
+
+    # Resolve the lambda once and apply it to each item (a tuple of positional args or a single arg),
+    # yielding results in order.  With workers > 1, chunks run in parallel on a thread pool with a bounded
+    # number of chunks in flight.  Like apply, exceptions are returned in place of the result.
+    def map(self, src, iterable, chunk_size=1000, workers=1):
+        fn = self.resolve_lambda(src)
+        if workers <= 1:
+            for chunk in _chunks(iterable, chunk_size):
+                yield from self.__apply_chunk(src, fn, chunk)
+            return
+        if self.__batch_executor is None:
+            self.__batch_executor = ThreadPoolExecutor(max_workers=self.dispatcher.max_workers,
+                                                       thread_name_prefix="push-batch")
+        pending = deque()
+        for chunk in _chunks(iterable, chunk_size):
+            pending.append(self.__batch_executor.submit(self.__apply_chunk, src, fn, chunk))
+            if len(pending) >= workers:
+                yield from pending.popleft().result()
+        while len(pending) > 0:
+            yield from pending.popleft().result()
+
+    def apply_many(self, src, iterable, chunk_size=1000, workers=1):
+        return list(self.map(src, iterable, chunk_size=chunk_size, workers=workers))
+
     # TODO: pass args, kwargs to task thread
     # TODO: construct a task runtime context based on provided ctx
     def start_daemon(self, src, *args, **kwargs):
@@ -69,19 +595,83 @@ class TaskManager:
         name = name or str(uuid.uuid4())
         if name in self.task_threads:
             raise RuntimeError(f"task already running: {name}")
+        self.abandoned.pop(name, None)
+        self.task_threads[name] = self.__start(src, args)
+
+    # without auto_ready the daemon is only considered ready once it calls control.ready() itself
+    def __start(self, src, args, auto_ready=True):
         src = load_lambda(self.code_store, src)
         task_control = TaskControl()
-        task_context = TaskContext(task_control,
-                                   threading.Thread(target=src, daemon=True, args=(task_control, *args)))
-        task_context.thread.start()
-        self.task_threads[name] = task_context
+        if asyncio.iscoroutinefunction(src) or asyncio.iscoroutinefunction(getattr(src, '__call__', None)):
+            runner = _run_async_daemon(task_control, src, args, auto_ready)
+            return TaskContext(task_control, None, self.submit_awaitable(runner))
+        thread = threading.Thread(target=_run_daemon, daemon=True, args=(task_control, src, args, auto_ready))
+        thread.start()
+        return TaskContext(task_control, thread)
+
+    def get_future(self, name):
+        task_context = self.task_threads.get(name)
+        return task_context.future if task_context is not None else None
+
+    # Cancel the daemon and give it `timeout` seconds to drain.  Returns False if it did not finish in time,
+    # in which case it is recorded in self.abandoned (after cancelling it if it is async; threads cannot be
+    # killed) rather than silently dropped, until it finishes or a daemon of the same name is started.
+    def stop(self, name, timeout=10):
+        task_context = self.task_threads.get(name)
+        if task_context is None:
+            return True
+        stopped = self.__stop(name, task_context, timeout)
+        if self.task_threads.get(name) is task_context:
+            del self.task_threads[name]
+        return stopped
 
-    def stop(self, name):
-        if name not in self.task_threads:
+    def __stop(self, name, task_context, timeout):
+        task_context.control.cancel(deadline=time.time() + timeout)
+        if task_context.future is not None:
+            timed_out = len(wait_futures([task_context.future], timeout=timeout).done) == 0
+        else:
+            task_context.thread.join(timeout=timeout)
+            timed_out = task_context.thread.is_alive()
+        if not timed_out:
+            return True
+        print(f"task did not stop within {timeout}s: {name}")
+        task_context.control.state = TASK_ABANDONED
+        if task_context.future is not None:
+            task_context.future.cancel()
+        self.abandoned[name] = task_context
+        return False
+
+    def __prune_abandoned(self):
+        for name, task_context in list(self.abandoned.items()):
+            if not task_context.is_alive() and self.abandoned.get(name) is task_context:
+                del self.abandoned[name]
+
+    # Replace a running daemon with a new version.  With hot_swap the new version is started first and the
+    # old one is only stopped once the new one is ready (if ready_timeout is given, the new daemon must call
+    # control.ready() within it or it is stopped and the old one is left running).
+    def redeploy(self, name, src, *args, hot_swap=True, ready_timeout=None, timeout=10):
+        old = self.task_threads.get(name)
+        self.abandoned.pop(name, None)
+        if old is None or not hot_swap:
+            if old is not None:
+                self.stop(name, timeout=timeout)
+            self.task_threads[name] = self.__start(src, args)
             return
-        self.task_threads[name].control.running = False
-        self.task_threads[name].thread.join(timeout=10)
-        del self.task_threads[name]
+        new = self.__start(src, args, auto_ready=ready_timeout is None)
+        if ready_timeout is not None and not new.control.wait_ready(ready_timeout):
+            self.__stop(name, new, timeout)
+            raise RuntimeError(f"new version of {name} not ready within {ready_timeout}s")
+        self.task_threads[name] = new
+        return self.__stop(name, old, timeout)
+
+    def health(self, name=None):
+        self.__prune_abandoned()
+        if name is not None:
+            task_context = self.task_threads.get(name) or self.abandoned.get(name)
+            return task_context.control.health() if task_context is not None else None
+        h = {k: v.control.health() for k, v in self.abandoned.items()}
+        h.update({k: v.control.health() for k, v in self.task_threads.items()})
+        return h
 
     def run(self, task_type, src, *args, **kwargs):
         if task_type == "daemon":
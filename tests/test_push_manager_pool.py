@@ -0,0 +1,87 @@
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from pushpy.push_manager import PushManagerPool
+
+# a PushManager server with an echo object, run in its own process so it can be restarted
+SERVER = """
+import sys
+from pushpy.push_manager import PushManager
+
+class Echo:
+    def echo(self, x):
+        return x
+
+class Registry:
+    def apply(self):
+        return list(PushManager._registry.keys())
+
+echo = Echo()
+PushManager.register("get_registry", callable=lambda: Registry())
+PushManager.register("echo", callable=lambda: echo)
+PushManager(address=("127.0.0.1", int(sys.argv[1])), authkey=b'password').get_server().serve_forever()
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(port):
+    p = subprocess.Popen([sys.executable, "-c", SERVER, str(port)])
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return p
+        except OSError:
+            time.sleep(0.05)
+    p.kill()
+    raise RuntimeError("server did not start")
+
+
+def stop_server(p):
+    p.kill()
+    p.wait()
+
+
+@pytest.fixture
+def port():
+    return free_port()
+
+
+def test_proxy_reconnects_after_restart(port):
+    host = f"127.0.0.1:{port}"
+    server = start_server(port)
+    pool = PushManagerPool(authkey=b'password', check_interval=0, min_backoff=0.01)
+    try:
+        proxy = pool.proxy(host, "echo")
+        assert proxy.echo(1) == 1
+        stop_server(server)
+        server = start_server(port)
+        assert proxy.echo(2) == 2
+        # a new pool connecting to the restarted server as well
+        assert PushManagerPool(authkey=b'password').proxy(host, "echo").echo(3) == 3
+    finally:
+        stop_server(server)
+
+
+def test_connection_released_on_remote_error(port):
+    host = f"127.0.0.1:{port}"
+    server = start_server(port)
+    pool = PushManagerPool(authkey=b'password', max_managers_per_host=1)
+    try:
+        for _ in range(3):
+            with pytest.raises(Exception):
+                with pool.connection(host, timeout=1) as m:
+                    m.echo().missing_method()
+        with pool.connection(host, timeout=1) as m:
+            assert m.echo().echo(4) == 4
+    finally:
+        stop_server(server)